@@ -1,28 +1,38 @@
+import os
+import re
+import math
 import time
+import hashlib
 import argparse
 import logging
 import json
 import gzip
 import xml.etree.ElementTree
 import xml.etree.ElementTree as ET
-from io import BytesIO
 from pathlib import Path
 from datetime import datetime, timezone
+from typing import TYPE_CHECKING
 
-import dateutil.parser
 import requests
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
-import pandas as pd
-import boto3
 
-from bus_data_models import Base, BusLocation
 import credentials
+from s3_upload import push_json_to_s3
+
+# The database, S3 and pool dependencies are heavy, so they are only imported
+# once we know which sinks are enabled. That keeps a plain JSON collector small
+# and quick to start.
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
 
 BODS_LOCATION_API_URL = (
     "https://data.bus-data.dft.gov.uk/api/v1/datafeed?operatorRef={}&api_key={}"
 )
 
+# Columns not useful on the front end
+JSON_DROPPED_COLUMNS = ["entry_id", "origin_ref", "destination_ref", "line_ref"]
+# Shortened directions, to remove some unnecessary charaters
+JSON_DIRECTION_ABBREVIATIONS = {"INBOUND": "I", "OUTBOUND": "O"}
+
 
 def convert_activity_to_dict(activity: xml.etree.ElementTree.Element) -> dict:
     """
@@ -92,6 +102,54 @@ def convert_activity_to_dict(activity: xml.etree.ElementTree.Element) -> dict:
     }
 
 
+def prepare_json_reports(bus_loc_list: list) -> list:
+    """
+    Prepares bus location dictionaries for export, removing the fields not
+    needed on the front end.
+
+    Parameters
+    ---------
+    bus_loc_list: list
+        A list of bus location report dictionaries.
+
+    Returns
+    -------
+    list
+        A list of trimmed bus location report dictionaries.
+    """
+    output_list = []
+    for bus_loc_report in bus_loc_list:
+        output_report = {
+            key: value
+            for key, value in bus_loc_report.items()
+            if key not in JSON_DROPPED_COLUMNS
+        }
+        output_report["direction_ref"] = JSON_DIRECTION_ABBREVIATIONS.get(
+            output_report["direction_ref"], output_report["direction_ref"]
+        )
+        output_list.append(output_report)
+    return output_list
+
+
+def write_file_atomically(output_path: Path, contents: str):
+    """
+    Writes to a temporary file then renames it into place, so readers never see
+    a partly written file.
+
+    Parameters
+    ----------
+    output_path : Path
+        Path to save to.
+    contents : str
+        The contents to write.
+
+    """
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(contents)
+    os.replace(tmp_path, output_path)
+
+
 def output_json(bus_loc_list: list, output_path: Path):
     """
     Takes a list of bus location dictionaries, prepares them for export then
@@ -110,21 +168,11 @@ def output_json(bus_loc_list: list, output_path: Path):
         A string representation of the JSON object.
     """
 
-    # Convert to a DF and get rid of some of the columns not useful on the
-    # front end
-    output_df = pd.DataFrame(json_output_list).drop(
-        ["entry_id", "origin_ref", "destination_ref", "line_ref"], axis=1
-    )
-    # Remove some unnecessary charaters
-    output_df.loc[output_df["direction_ref"] == "INBOUND", ["direction_ref"]] = "I"
-    output_df.loc[output_df["direction_ref"] == "OUTBOUND", ["direction_ref"]] = "O"
-
     # We want to write and have the option to put it on S3, so we do it
     # this way
-    df_str = output_df.to_dict(orient="records")
     json_str = json.dumps({
         "timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-        "data": df_str
+        "data": prepare_json_reports(bus_loc_list)
     })
 
     with open(output_path, "w") as f:
@@ -133,7 +181,177 @@ def output_json(bus_loc_list: list, output_path: Path):
     return json_str
 
 
-def add_bus_location_to_db_session(bus_loc_report: dict, db_session: Session):
+class ShardedOutput:
+    """
+    Writes the latest bus locations as small JSON shards, one per line_ref and
+    one per geographic tile, plus an index manifest listing them. Clients only
+    need to fetch the shards they display.
+
+    Each shard's data is hashed so we can tell which shards have changed since
+    they were last uploaded. What was last uploaded is read back from the
+    manifest in S3 before the first upload, so shards uploaded by an earlier
+    run, or by another worker in the pool, are updated and removed correctly.
+
+    Parameters
+    ----------
+    shard_dir : Path
+        Directory to write the shards and manifest to.
+    tile_size : float (default 0.1)
+        Width and height of each tile in degrees.
+    """
+
+    def __init__(self, shard_dir: Path, tile_size: float = 0.1):
+        self.shard_dir = Path(shard_dir)
+        (self.shard_dir / "line").mkdir(parents=True, exist_ok=True)
+        (self.shard_dir / "tile").mkdir(parents=True, exist_ok=True)
+        self.tile_size = tile_size
+
+        # Shard path -> data hash, for what is on disk and what has been uploaded
+        self.current_hashes = {}
+        self.uploaded_hashes = None
+
+    def tile_key(self, bus_loc_report: dict) -> str:
+        return "{}_{}".format(
+            math.floor(bus_loc_report["vehicle_lat"] / self.tile_size),
+            math.floor(bus_loc_report["vehicle_lon"] / self.tile_size),
+        )
+
+    @staticmethod
+    def line_key(bus_loc_report: dict) -> str:
+        # Keep line refs safe to use as file names
+        return re.sub(r"[^A-Za-z0-9_-]", "_", str(bus_loc_report["line_ref"]))
+
+    def write(self, bus_loc_list: list) -> dict:
+        """
+        Writes a shard for each line and tile, removes shards which no longer
+        have any buses and updates the manifest.
+
+        Parameters
+        ----------
+        bus_loc_list : list
+            A list of bus location report dictionaries.
+
+        Returns
+        -------
+        dict
+            The current manifest.
+        """
+        shards = {}
+        for bus_loc_report in bus_loc_list:
+            for shard_path in [
+                "line/{}.json".format(self.line_key(bus_loc_report)),
+                "tile/{}.json".format(self.tile_key(bus_loc_report)),
+            ]:
+                shards.setdefault(shard_path, []).append(bus_loc_report)
+
+        timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        new_hashes = {}
+        for shard_path, shard_reports in shards.items():
+            data = prepare_json_reports(shard_reports)
+            data_hash = hashlib.sha1(
+                json.dumps(data, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+            new_hashes[shard_path] = data_hash
+            # Only rewrite shards whose buses have moved
+            if self.current_hashes.get(shard_path) != data_hash:
+                write_file_atomically(
+                    self.shard_dir / shard_path,
+                    json.dumps({"timestamp": timestamp, "data": data}),
+                )
+
+        for shard_path in set(self.current_hashes) - set(new_hashes):
+            try:
+                (self.shard_dir / shard_path).unlink()
+            except FileNotFoundError:
+                pass
+        self.current_hashes = new_hashes
+
+        manifest = {
+            "timestamp": timestamp,
+            "tile_size": self.tile_size,
+            "shards": {
+                shard_path: {"hash": data_hash, "count": len(shards[shard_path])}
+                for shard_path, data_hash in sorted(new_hashes.items())
+            },
+        }
+        write_file_atomically(self.shard_dir / "manifest.json", json.dumps(manifest))
+        return manifest
+
+    def load_uploaded_manifest(self, s3, key_prefix: str):
+        """
+        Sets the uploaded shard hashes from the manifest in S3, if there is one.
+
+        Parameters
+        ----------
+        s3 : boto3 S3 resource
+            The S3 resource to download with.
+        key_prefix : str
+            Prefix for the S3 keys.
+
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            manifest_obj = s3.Object(
+                credentials.S3_BUCKET_NAME, key_prefix + "manifest.json"
+            ).get()
+            manifest = json.loads(gzip.decompress(manifest_obj["Body"].read()))
+        except ClientError as e:
+            # Nothing uploaded yet
+            logging.info("No manifest at {}: {}".format(key_prefix, e))
+            manifest = {"shards": {}}
+        self.uploaded_hashes = {
+            shard_path: shard["hash"]
+            for shard_path, shard in manifest["shards"].items()
+        }
+
+    def changed_shards(self) -> list:
+        """Returns the shard paths which have changed since they were uploaded."""
+        return [
+            shard_path
+            for shard_path, data_hash in self.current_hashes.items()
+            if self.uploaded_hashes.get(shard_path) != data_hash
+        ]
+
+    def removed_shards(self) -> list:
+        """Returns the uploaded shard paths which no longer exist."""
+        return [
+            shard_path
+            for shard_path in self.uploaded_hashes
+            if shard_path not in self.current_hashes
+        ]
+
+    def push_to_s3(self, s3, key_prefix: str):
+        """
+        Uploads the changed shards, deletes removed ones, then uploads the
+        manifest if anything changed. On the first upload, the uploaded
+        manifest is read first.
+
+        Parameters
+        ----------
+        s3 : boto3 S3 resource
+            The S3 resource to upload with.
+        key_prefix : str
+            Prefix for the S3 keys.
+
+        """
+        if self.uploaded_hashes is None:
+            self.load_uploaded_manifest(s3, key_prefix)
+        changed = self.changed_shards()
+        removed = self.removed_shards()
+        for shard_path in changed:
+            with open(self.shard_dir / shard_path) as f:
+                push_json_to_s3(s3, key_prefix + shard_path, f.read())
+            self.uploaded_hashes[shard_path] = self.current_hashes[shard_path]
+        for shard_path in removed:
+            s3.Object(credentials.S3_BUCKET_NAME, key_prefix + shard_path).delete()
+            del self.uploaded_hashes[shard_path]
+        if len(changed) > 0 or len(removed) > 0:
+            with open(self.shard_dir / "manifest.json") as f:
+                push_json_to_s3(s3, key_prefix + "manifest.json", f.read())
+
+
+def add_bus_location_to_db_session(bus_loc_report: dict, db_session: "Session"):
     """
     Simply adds a bus location report to the current database session. Note that this function converts string ISO timestamps to database objects.
 
@@ -149,27 +367,9 @@ def add_bus_location_to_db_session(bus_loc_report: dict, db_session: Session):
     Nothing.
 
     """
-    bus_location = BusLocation(
-        entry_id=bus_loc_report["entry_id"],
-        timestamp=dateutil.parser.isoparse(bus_loc_report["timestamp"]),
-        line_ref=bus_loc_report["line_ref"],
-        direction_ref=bus_loc_report["direction_ref"],
-        line_name=bus_loc_report["line_name"],
-        operator_ref=bus_loc_report["operator_ref"],
-        origin_ref=bus_loc_report["origin_ref"],
-        origin_name=bus_loc_report["origin_name"],
-        destination_ref=bus_loc_report["destination_ref"],
-        destination_name=bus_loc_report["destination_name"],
-        origin_aimed_departure_time=dateutil.parser.isoparse(
-            bus_loc_report["origin_aimed_departure_time"]
-        ),
-        vehicle_lat=bus_loc_report["vehicle_lat"],
-        vehicle_lon=bus_loc_report["vehicle_lon"],
-        vehicle_bearing=bus_loc_report["vehicle_bearing"],
-        vehicle_journey_ref=bus_loc_report["vehicle_journey_ref"],
-        vehicle_ref=bus_loc_report["vehicle_ref"],
-    )
-    session.add(bus_location)
+    from bus_data_models import BusLocation, bus_location_mapping
+
+    db_session.add(BusLocation(**bus_location_mapping(bus_loc_report)))
 
 
 if __name__ == "__main__":
@@ -184,7 +384,9 @@ if __name__ == "__main__":
         default=False,
     )
     parser.add_argument(
-        "operator_code", help="The BODS operator code to grab.", type=str
+        "operator_code",
+        help="The BODS operator code to grab. With --worker_pool, a comma separated list of codes to share across the pool.",
+        type=str,
     )
     parser.add_argument(
         "output_path", help="Location to save each update to.", type=str
@@ -213,6 +415,54 @@ if __name__ == "__main__":
         type=int,
         default=3
     )
+    parser.add_argument(
+        "--worker_pool",
+        help="Share the operator codes with other collectors through the database, so each is polled by exactly one worker.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--worker_id",
+        help="Unique ID of this worker in the pool. Defaults to hostname-pid.",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        help="How long a worker holds an operator without renewing it. If a worker dies, its operators are picked up after this long.",
+        type=int,
+        default=60,
+    )
+    parser.add_argument(
+        "--request_timeout",
+        help="Seconds to wait for the BODS API before giving up on a poll. Must be shorter than --lease_seconds.",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--spool_dir",
+        help="Directory to spool reports to when the database can't accept them.",
+        type=str,
+        default="spool",
+    )
+    parser.add_argument(
+        "--spool_max_mb",
+        help="Maximum size of the spool in megabytes. Reports beyond this are dropped.",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--shard_dir",
+        help="Also write per line and per tile JSON shards, plus a manifest, to this directory.",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--shard_tile_size",
+        help="Width and height of each geographic shard in degrees.",
+        type=float,
+        default=0.1,
+    )
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -232,7 +482,13 @@ if __name__ == "__main__":
         print("Path {} exists - will be overwritten.".format(output_path))
 
     # Set up the DB
-    if args.db:
+    if args.db or args.worker_pool:
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+
+        from bus_data_models import Base
+        from location_spool import LocationSpool
+
         engine = create_engine(
             "postgresql://{}:{}@{}:{}".format(
                 credentials.POSTGRES_USER,
@@ -246,62 +502,185 @@ if __name__ == "__main__":
         DBSession = sessionmaker(bind=engine)
         session = DBSession()
 
+        spool = LocationSpool(args.spool_dir, max_bytes=args.spool_max_mb * 1024 * 1024)
+
     # Set up AWS
     if args.aws:
-        s3 = boto3.resource("s3")
-
-    # Set up operator code and URL to query
-    operator_ref = args.operator_code
-    location_url = BODS_LOCATION_API_URL.format(operator_ref, credentials.BODS_API_KEY)
+        import boto3
 
-    # Loop to get latest data
-    aws_interval_counter = 0
-    while True:
-        try:
-            # Get the latest info
-            resp = requests.get(location_url)
-            tree = ET.fromstring(resp.text)
+        s3 = boto3.resource("s3")
 
-            # Extract the activities
-            activities = tree.findall(
-                "./{http://www.siri.org.uk/siri}ServiceDelivery/{http://www.siri.org.uk/siri}VehicleMonitoringDelivery/{http://www.siri.org.uk/siri}VehicleActivity"
-            )
+    # Set up the operators to poll. In pool mode we are given the full list
+    # and only poll those we hold a lease for.
+    operator_refs = args.operator_code.split(",")
+    if args.worker_pool:
+        from collector_pool import (
+            default_worker_id,
+            claim_operators,
+            holds_lease,
+            release_operators,
+        )
 
-            # Convert each to JSON
-            json_output_list = []
-            for activity in activities:
-                converted_activity = convert_activity_to_dict(activity)
-                json_output_list.append(converted_activity)
+        if args.request_timeout >= args.lease_seconds:
+            raise ValueError("--request_timeout must be shorter than --lease_seconds.")
 
-                # Add to database if needed
-                if args.db:
-                    add_bus_location_to_db_session(converted_activity, session)
+        worker_id = args.worker_id or default_worker_id()
+        logging.info("Joining collector pool as {}".format(worker_id))
+    elif len(operator_refs) > 1:
+        raise ValueError("Multiple operator codes can only be used with --worker_pool.")
+    held_operator_refs = operator_refs
 
-            json_str = output_json(json_output_list, output_path)
+    # Loop to get latest data
+    aws_interval_counter = 0
+    sharded_outputs = {}
+    try:
+        while True:
+            if args.worker_pool:
+                try:
+                    new_held_operator_refs = claim_operators(
+                        session, worker_id, operator_refs, args.lease_seconds
+                    )
+                except Exception as e:
+                    # If we can't renew our leases another worker may take
+                    # them over, so stop polling until we can
+                    session.rollback()
+                    new_held_operator_refs = []
+                    logging.error("Error claiming operators: {}".format(e))
+                if new_held_operator_refs != held_operator_refs:
+                    logging.info("Now polling: {}".format(new_held_operator_refs))
+                held_operator_refs = new_held_operator_refs
+                # Another worker may update an operator's shards while we
+                # don't hold it, so start afresh if we get it back
+                for operator_ref in set(sharded_outputs) - set(held_operator_refs):
+                    del sharded_outputs[operator_ref]
 
             aws_interval_counter += 1
-
-            # if using AWS, push to bucket
-            if args.aws and aws_interval_counter >= args.aws_push_interval:
+            push_to_aws = args.aws and aws_interval_counter >= args.aws_push_interval
+            if push_to_aws:
                 aws_interval_counter = 0
-                # Great snippet from https://gist.github.com/veselosky/9427faa38cee75cd8e27
-                upload_obj = BytesIO()
-                json_comp = gzip.GzipFile(None, 'w', 9, upload_obj)
-                json_comp.write(json_str.encode('utf-8'))
-                json_comp.close()
-                s3.Bucket(credentials.S3_BUCKET_NAME).put_object(
-                    Key=args.aws_filename, 
-                    Body=upload_obj.getvalue(), 
-                    ACL="public-read",
-                    ContentType='application/json',
-                    ContentEncoding='gzip',
-                )
-                
-
-            # Commit to Database
-            if args.db:
-                session.commit()
-        except Exception as e:
-            logging.error("Error getting data: {}".format(e))
 
-        time.sleep(args.sleep_interval)
+            for operator_ref in held_operator_refs:
+                if args.worker_pool:
+                    operator_output_path = output_path.with_name(
+                        "{}_{}{}".format(output_path.stem, operator_ref, output_path.suffix)
+                    )
+                    aws_filename = "{}_{}".format(operator_ref, args.aws_filename)
+                else:
+                    operator_output_path = output_path
+                    aws_filename = args.aws_filename
+
+                # Make sure our lease will outlast the poll, so we never poll
+                # an operator another worker has taken over
+                if args.worker_pool:
+                    try:
+                        lease_held = holds_lease(
+                            session, worker_id, operator_ref, args.request_timeout
+                        )
+                    except Exception as e:
+                        session.rollback()
+                        lease_held = False
+                        logging.error("Error checking lease: {}".format(e))
+                    if not lease_held:
+                        logging.warning(
+                            "Lease on {} lost or expiring, skipping".format(operator_ref)
+                        )
+                        sharded_outputs.pop(operator_ref, None)
+                        continue
+
+                try:
+                    location_url = BODS_LOCATION_API_URL.format(
+                        operator_ref, credentials.BODS_API_KEY
+                    )
+                    # Get the latest info
+                    resp = requests.get(location_url, timeout=args.request_timeout)
+                    tree = ET.fromstring(resp.text)
+
+                    # Extract the activities
+                    activities = tree.findall(
+                        "./{http://www.siri.org.uk/siri}ServiceDelivery/{http://www.siri.org.uk/siri}VehicleMonitoringDelivery/{http://www.siri.org.uk/siri}VehicleActivity"
+                    )
+
+                    # Convert each to JSON
+                    json_output_list = []
+                    for activity in activities:
+                        converted_activity = convert_activity_to_dict(activity)
+                        json_output_list.append(converted_activity)
+
+                    # If we have definitely lost the lease during the poll, the
+                    # new holder records and publishes this operator, so skip
+                    # the database and the live outputs. If we can't tell
+                    # because the database is down, carry on - duplicates are
+                    # dropped by the summariser.
+                    if args.worker_pool:
+                        lease_held = True
+                        try:
+                            lease_held = holds_lease(session, worker_id, operator_ref)
+                        except Exception:
+                            session.rollback()
+                        if not lease_held:
+                            logging.warning(
+                                "Lease on {} lost during poll, skipping".format(
+                                    operator_ref
+                                )
+                            )
+                            sharded_outputs.pop(operator_ref, None)
+                            continue
+
+                    # Commit to Database first. If it can't take the reports, spool
+                    # them locally and catch up once it is back.
+                    if args.db:
+                        try:
+                            for converted_activity in json_output_list:
+                                add_bus_location_to_db_session(converted_activity, session)
+                            session.commit()
+                        except Exception as e:
+                            session.rollback()
+                            spool.write(json_output_list)
+                            logging.error(
+                                "Error writing to database, spooled {} reports: {}".format(
+                                    len(json_output_list), e
+                                )
+                            )
+                            spool.log_stats()
+                        else:
+                            if not spool.is_empty():
+                                spool.drain(session)
+                                spool.log_stats()
+
+                    # The live outputs come after the database write, and have
+                    # their own error handling, so a disk or S3 failure can't
+                    # lose reports
+                    try:
+                        json_str = output_json(json_output_list, operator_output_path)
+
+                        if args.shard_dir is not None:
+                            if operator_ref not in sharded_outputs:
+                                sharded_outputs[operator_ref] = ShardedOutput(
+                                    Path(args.shard_dir) / operator_ref, args.shard_tile_size
+                                )
+                            sharded_outputs[operator_ref].write(json_output_list)
+
+                        # if using AWS, push to bucket
+                        if push_to_aws:
+                            push_json_to_s3(s3, aws_filename, json_str)
+                            if args.shard_dir is not None:
+                                sharded_outputs[operator_ref].push_to_s3(
+                                    s3, "shards/{}/".format(operator_ref)
+                                )
+                    except Exception as e:
+                        logging.error(
+                            "Error writing outputs for {}: {}".format(operator_ref, e)
+                        )
+                except Exception as e:
+                    logging.error("Error getting data for {}: {}".format(operator_ref, e))
+
+            time.sleep(args.sleep_interval)
+    finally:
+        if args.worker_pool:
+            # We may have stopped part way through a batch or a failed
+            # transaction, so don't commit any of it with the release
+            try:
+                session.rollback()
+                release_operators(session, worker_id)
+            except Exception as e:
+                logging.error("Error releasing operators: {}".format(e))
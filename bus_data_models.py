@@ -1,13 +1,38 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Float
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Float, Boolean
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
+import dateutil.parser
 
-import credentials
 
 Base = declarative_base()
 
 
+# Covering indexes for looking up a vehicle's or journey's track by time. These
+# need INCLUDE, which SQLAlchemy can't express here, so they are created
+# separately by create_track_indexes. CONCURRENTLY avoids locking the table
+# while they build.
+TRACK_COLUMNS = [
+    "timestamp",
+    "vehicle_ref",
+    "vehicle_journey_ref",
+    "line_ref",
+    "direction_ref",
+    "vehicle_lat",
+    "vehicle_lon",
+    "vehicle_bearing",
+]
+TRACK_INDEX_SQL = [
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bus_location_vehicle_ref_timestamp
+    ON bus_location (vehicle_ref, timestamp)
+    INCLUDE (vehicle_journey_ref, line_ref, direction_ref, vehicle_lat, vehicle_lon, vehicle_bearing);""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bus_location_vehicle_journey_ref_timestamp
+    ON bus_location (vehicle_journey_ref, timestamp)
+    INCLUDE (vehicle_ref, line_ref, direction_ref, vehicle_lat, vehicle_lon, vehicle_bearing);""",
+]
+
+
 class BusLocation(Base):
     __tablename__ = "bus_location"
     id = Column(Integer, primary_key=True)
@@ -28,6 +53,45 @@ class BusLocation(Base):
     vehicle_journey_ref = Column(String(50))
     vehicle_ref = Column(String(25))
 
+
+def bus_location_mapping(bus_loc_report: dict) -> dict:
+    """
+    Converts a bus location report into a mapping of BusLocation columns, turning
+    the string ISO timestamps into datetimes.
+
+    Parameters
+    ----------
+    bus_loc_report : dict
+        A bus location report, as prepared by convert_activity_to_dict.
+
+    Returns
+    -------
+    dict
+        The column values for a BusLocation row.
+
+    """
+    return {
+        "entry_id": bus_loc_report["entry_id"],
+        "timestamp": dateutil.parser.isoparse(bus_loc_report["timestamp"]),
+        "line_ref": bus_loc_report["line_ref"],
+        "direction_ref": bus_loc_report["direction_ref"],
+        "line_name": bus_loc_report["line_name"],
+        "operator_ref": bus_loc_report["operator_ref"],
+        "origin_ref": bus_loc_report["origin_ref"],
+        "origin_name": bus_loc_report["origin_name"],
+        "destination_ref": bus_loc_report["destination_ref"],
+        "destination_name": bus_loc_report["destination_name"],
+        "origin_aimed_departure_time": dateutil.parser.isoparse(
+            bus_loc_report["origin_aimed_departure_time"]
+        ),
+        "vehicle_lat": bus_loc_report["vehicle_lat"],
+        "vehicle_lon": bus_loc_report["vehicle_lon"],
+        "vehicle_bearing": bus_loc_report["vehicle_bearing"],
+        "vehicle_journey_ref": bus_loc_report["vehicle_journey_ref"],
+        "vehicle_ref": bus_loc_report["vehicle_ref"],
+    }
+
+
 class JourneySummary(Base):
     __tablename__ = "journey_summary"
     id = Column(Integer, primary_key=True)
@@ -57,7 +121,65 @@ class JourneySummary(Base):
     speed_mean_mph = Column(Float)
 
 
+class Headway(Base):
+    __tablename__ = "headway"
+    id = Column(Integer, primary_key=True)
+    date = Column(DateTime)
+    line_ref = Column(String(10))
+    direction_ref = Column(String(20))
+    origin_ref = Column(String(20))
+    checkpoint_miles = Column(Float)
+    hour = Column(DateTime)
+    passage_time = Column(DateTime)
+    vehicle_ref = Column(String(25))
+    leading_vehicle_ref = Column(String(25))
+    headway_mins = Column(Float)
+    is_bunched = Column(Boolean)
+
+
+class SpeedCell(Base):
+    __tablename__ = "speed_cell"
+    id = Column(Integer, primary_key=True)
+    date = Column(DateTime)
+    cell_size = Column(Float)
+    lat_idx = Column(Integer)
+    lon_idx = Column(Integer)
+    hour_of_day = Column(Integer)
+    count = Column(Integer)
+    speed_sum = Column(Float)
+    speed_min = Column(Float)
+    speed_max = Column(Float)
+    speed_histogram = Column(ARRAY(Integer))
+
+
+class CollectorWorker(Base):
+    __tablename__ = "collector_worker"
+    worker_id = Column(String(100), primary_key=True)
+    last_seen = Column(DateTime)
+
+
+class CollectorLease(Base):
+    __tablename__ = "collector_lease"
+    operator_ref = Column(String(20), primary_key=True)
+    worker_id = Column(String(100), nullable=True)
+    expires_at = Column(DateTime)
+
+
+def create_track_indexes(engine):
+    """
+    Creates the covering indexes used by track_lookup.py, if they don't exist.
+    """
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        for index_sql in TRACK_INDEX_SQL:
+            connection.execute(index_sql)
+
+
 if __name__ == "__main__":
+    # Only needed when run as a script, so the functions above can be imported
+    # without a credentials file
+    import credentials
+
     engine = create_engine(
         "postgresql://{}:{}@{}:{}".format(
             credentials.POSTGRES_USER,
@@ -67,4 +189,5 @@ if __name__ == "__main__":
         )
     )
     Base.metadata.create_all(engine)
+    create_track_indexes(engine)
     print("Done!")
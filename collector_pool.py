@@ -0,0 +1,221 @@
+import math
+import socket
+import os
+import datetime
+
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from bus_data_models import CollectorLease, CollectorWorker
+
+
+def default_worker_id() -> str:
+    """
+    Builds a worker ID which is unique across hosts and processes.
+
+    Returns
+    -------
+    str
+        The worker ID, as hostname-pid.
+    """
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def heartbeat(db_session: Session, worker_id: str):
+    """
+    Records that a worker is still alive. Workers which haven't sent a heartbeat
+    within the lease length are not counted when sharing out operators.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session.
+    worker_id : str
+        ID of this worker.
+
+    """
+    db_session.execute(
+        insert(CollectorWorker.__table__)
+        .values(worker_id=worker_id, last_seen=func.now())
+        .on_conflict_do_update(
+            index_elements=["worker_id"], set_={"last_seen": func.now()}
+        )
+    )
+
+
+def claim_operators(
+    db_session: Session,
+    worker_id: str,
+    operator_refs: list,
+    lease_seconds: int = 60,
+) -> list:
+    """
+    Renews this worker's leases and claims or releases operators so that the
+    pool shares the operator list evenly. Each operator can only be leased by a
+    single worker at once, so no operator is polled twice. If a worker dies its
+    leases expire and are picked up by the rest of the pool.
+
+    All timings use the database clock so the hosts don't need to agree on the
+    time.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session.
+    worker_id : str
+        ID of this worker.
+    operator_refs : list
+        All operator codes the pool is responsible for.
+    lease_seconds : int (default 60)
+        How long a lease lasts without being renewed. This must be comfortably
+        longer than the time taken to poll every operator the worker holds.
+
+    Returns
+    -------
+    list
+        The operator codes this worker now holds.
+    """
+    lease_length = datetime.timedelta(seconds=lease_seconds)
+
+    heartbeat(db_session, worker_id)
+
+    # Make sure there is a lease row for every operator
+    db_session.execute(
+        insert(CollectorLease.__table__)
+        .values(
+            [
+                {"operator_ref": operator_ref, "worker_id": None}
+                for operator_ref in operator_refs
+            ]
+        )
+        .on_conflict_do_nothing(index_elements=["operator_ref"])
+    )
+
+    num_live_workers = (
+        db_session.query(func.count(CollectorWorker.worker_id))
+        .filter(CollectorWorker.last_seen > func.now() - lease_length)
+        .scalar()
+    )
+    fair_share = math.ceil(len(operator_refs) / max(num_live_workers, 1))
+
+    # Renew what we already hold - if a lease has been taken by another worker
+    # in the meantime, its worker_id will no longer match
+    held = [
+        lease.operator_ref
+        for lease in db_session.query(CollectorLease)
+        .filter(
+            CollectorLease.worker_id == worker_id,
+            CollectorLease.operator_ref.in_(operator_refs),
+        )
+        .order_by(CollectorLease.operator_ref)
+        .with_for_update()
+    ]
+
+    # Hand back any excess so new workers can pick it up
+    if len(held) > fair_share:
+        released = held[fair_share:]
+        held = held[:fair_share]
+        db_session.query(CollectorLease).filter(
+            CollectorLease.operator_ref.in_(released)
+        ).update(
+            {CollectorLease.worker_id: None, CollectorLease.expires_at: func.now()},
+            synchronize_session=False,
+        )
+
+    # Claim free or expired leases up to our fair share, skipping any another
+    # worker is claiming right now
+    if len(held) < fair_share:
+        claimed = [
+            lease.operator_ref
+            for lease in db_session.query(CollectorLease)
+            .filter(
+                CollectorLease.operator_ref.in_(operator_refs),
+                or_(
+                    CollectorLease.worker_id.is_(None),
+                    CollectorLease.expires_at < func.now(),
+                ),
+            )
+            .order_by(CollectorLease.operator_ref)
+            .limit(fair_share - len(held))
+            .with_for_update(skip_locked=True)
+        ]
+        held += claimed
+
+    if len(held) > 0:
+        db_session.query(CollectorLease).filter(
+            CollectorLease.operator_ref.in_(held)
+        ).update(
+            {
+                CollectorLease.worker_id: worker_id,
+                CollectorLease.expires_at: func.now() + lease_length,
+            },
+            synchronize_session=False,
+        )
+
+    db_session.commit()
+    return held
+
+
+def holds_lease(
+    db_session: Session, worker_id: str, operator_ref: str, margin_seconds: int = 0
+) -> bool:
+    """
+    Checks that a worker still holds an operator's lease, and that it won't
+    expire within margin_seconds. Workers check this before each poll and
+    database write, as a slow poll can outlast the lease and let another worker
+    take the operator over.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session.
+    worker_id : str
+        ID of this worker.
+    operator_ref : str
+        The operator to check.
+    margin_seconds : int (default 0)
+        How long the lease must still have to run.
+
+    Returns
+    -------
+    bool
+        True if the lease is held for at least margin_seconds more.
+    """
+    # now() is fixed at the start of the transaction, so use the actual time
+    num_held = (
+        db_session.query(func.count(CollectorLease.operator_ref))
+        .filter(
+            CollectorLease.operator_ref == operator_ref,
+            CollectorLease.worker_id == worker_id,
+            CollectorLease.expires_at
+            > func.clock_timestamp() + datetime.timedelta(seconds=margin_seconds),
+        )
+        .scalar()
+    )
+    return num_held > 0
+
+
+def release_operators(db_session: Session, worker_id: str):
+    """
+    Releases all of a worker's leases and removes its heartbeat, so the rest of
+    the pool can take over straight away rather than waiting for expiry.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session.
+    worker_id : str
+        ID of this worker.
+
+    """
+    db_session.query(CollectorLease).filter(
+        CollectorLease.worker_id == worker_id
+    ).update(
+        {CollectorLease.worker_id: None, CollectorLease.expires_at: func.now()},
+        synchronize_session=False,
+    )
+    db_session.query(CollectorWorker).filter(
+        CollectorWorker.worker_id == worker_id
+    ).delete(synchronize_session=False)
+    db_session.commit()
@@ -0,0 +1 @@
+# Lets pytest import the scripts in the repo root from tests/
@@ -1,18 +1,41 @@
 import datetime
 import argparse
 import json
-import gzip
-from io import BytesIO
+from pathlib import Path
 
 import dateutil.rrule
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, and_, text
 from sqlalchemy.orm import sessionmaker, Session
 from geopy import distance
 import boto3
 
-from bus_data_models import Base, BusLocation, JourneySummary
-import credentials
+from bus_data_models import Base, BusLocation, JourneySummary, Headway, SpeedCell
+from summariser_profiler import SummariserProfiler
+from s3_upload import push_json_to_s3
+
+# Columns which together identify a single bus journey
+JOURNEY_KEY_COLUMNS = [
+    "operator_ref",
+    "origin_aimed_departure_time",
+    "line_ref",
+    "vehicle_journey_ref",
+]
+
+# Mean radius of the Earth in miles, for vectorised haversine distances
+EARTH_RADIUS_MILES = 3958.8
+
+# Journeys on the same line and direction from the same origin are compared
+# for headways
+HEADWAY_GROUP_COLUMNS = ["line_ref", "direction_ref", "origin_ref"]
+
+# Speed cells are keyed on their grid position and hour of day
+SPEED_CELL_COLUMNS = ["lat_idx", "lon_idx", "hour_of_day"]
+# Segment speeds are counted into fixed buckets so approximate quantiles can be
+# merged across days. The last bucket also holds anything faster.
+SPEED_HISTOGRAM_BUCKET_MPH = 2.0
+SPEED_HISTOGRAM_NUM_BUCKETS = 40
 
 
 def preprocess_locations(
@@ -36,31 +59,27 @@ def preprocess_locations(
     raw_locations_df["hour"] = raw_locations_df["origin_aimed_departure_time"].dt.floor(
         "h"
     )
-    # Create a reference which ties a journey ref to a date - this is so we can handle
-    # multiple days of 'journey refs' at once, which seem to cycle
-    raw_locations_df["vehicle_journey_date_ref"] = (
-        raw_locations_df["origin_aimed_departure_time"].dt.strftime("%Y-%m-%d")
-        + "_"
-        + raw_locations_df["vehicle_journey_ref"]
-    )
-    raw_locations_df["journey_date_line_ref"] = (
-        raw_locations_df["operator_ref"]
-        + "_"
-        + raw_locations_df["origin_aimed_departure_time"].dt.strftime("%Y-%m-%dT%H:%M%s")
-        + "_"
-        + raw_locations_df["line_ref"]
-        + "_"
-        + raw_locations_df["vehicle_journey_ref"]
+    # Identify each journey with a compact integer key rather than building
+    # reference strings for every row. The keys are factorized from the same
+    # fields as journey_date_line_ref; the strings are only built once per journey
+    # in add_journey_refs. Journeys with a missing field get -1 and, as
+    # before, are kept here but not summarised.
+    key_codes = pd.DataFrame(
+        {
+            column: pd.factorize(raw_locations_df[column])[0]
+            for column in JOURNEY_KEY_COLUMNS
+        },
+        index=raw_locations_df.index,
     )
+    journey_key = key_codes.groupby(JOURNEY_KEY_COLUMNS, sort=False).ngroup().to_numpy()
+    journey_key[(key_codes < 0).any(axis=1).to_numpy()] = -1
+    raw_locations_df["journey_key"] = journey_key
 
-    jdl_count = raw_locations_df.groupby("journey_date_line_ref")["id"].count()
-    journeys_to_drop = jdl_count[jdl_count < drop_threshold].index.tolist()
-    rows_to_drop = raw_locations_df[
-        raw_locations_df["journey_date_line_ref"].isin(journeys_to_drop)
+    journey_counts = np.bincount(journey_key + 1)[journey_key + 1]
+    raw_locations_df = raw_locations_df[
+        (journey_key < 0) | (journey_counts >= drop_threshold)
     ]
 
-    raw_locations_df = raw_locations_df.drop(rows_to_drop.index)
-
     # To avoid weird re-ordering affects due to insertion order, we sort  by
     # timestamp then reset the index
     raw_locations_df = raw_locations_df.sort_values(by=["timestamp", "id"]).reset_index(
@@ -169,8 +188,9 @@ def summarise_journey(journey_df: pd.DataFrame) -> pd.DataFrame:
             "destination_ref",
             "destination_name",
             "hour",
-            "vehicle_journey_date_ref",
-            "journey_date_line_ref",
+            "operator_ref",
+            "origin_aimed_departure_time",
+            "vehicle_journey_ref",
             "vehicle_ref",
         ]
     ].iloc[0]
@@ -180,9 +200,46 @@ def summarise_journey(journey_df: pd.DataFrame) -> pd.DataFrame:
     return metadata.append(journey_stats)
 
 
+def add_journey_refs(summarised_journeys: pd.DataFrame) -> pd.DataFrame:
+    """
+    Builds the human readable journey references, once per journey, in place of
+    the fields they are made from.
+    """
+    # This ties a journey ref to a date - this is so we can handle multiple days
+    # of 'journey refs' at once, which seem to cycle
+    summarised_journeys["vehicle_journey_date_ref"] = (
+        summarised_journeys["origin_aimed_departure_time"].dt.strftime("%Y-%m-%d")
+        + "_"
+        + summarised_journeys["vehicle_journey_ref"]
+    )
+    summarised_journeys["journey_date_line_ref"] = (
+        summarised_journeys["operator_ref"]
+        + "_"
+        + summarised_journeys["origin_aimed_departure_time"].dt.strftime(
+            "%Y-%m-%dT%H:%M%s"
+        )
+        + "_"
+        + summarised_journeys["line_ref"]
+        + "_"
+        + summarised_journeys["vehicle_journey_ref"]
+    )
+    return summarised_journeys.drop(
+        ["operator_ref", "origin_aimed_departure_time", "vehicle_journey_ref"], axis=1
+    )
+
+
 def summarise_all_journeys(locations_df: pd.DataFrame):
     # First summarise all journeys
-    return locations_df.groupby(["journey_date_line_ref"]).apply(summarise_journey)
+    summarised_journeys = (
+        locations_df[locations_df["journey_key"] >= 0]
+        .groupby("journey_key")
+        .apply(summarise_journey)
+    )
+    summarised_journeys = add_journey_refs(summarised_journeys)
+    # Keep the journeys in reference order, as when we grouped by the strings
+    return summarised_journeys.sort_values(by="journey_date_line_ref").reset_index(
+        drop=True
+    )
 
 
 def summarise_hour(summary_journey_df: pd.DataFrame) -> pd.Series:
@@ -231,14 +288,18 @@ def convert_locations_to_journey_summaries(
 ) -> pd.DataFrame:
 
     processed_locations_df = preprocess_locations(locations_df)
-    if processed_locations_df.shape[0] >= 1:
+    if (processed_locations_df["journey_key"] >= 0).any():
         return summarise_all_journeys(processed_locations_df)
     else:
         return None
 
 
 def process_day(
-    db_session: Session, start_dt: datetime, end_dt: datetime, chunk_size: int = 1
+    db_session: Session,
+    start_dt: datetime,
+    end_dt: datetime,
+    chunk_size: int = 1,
+    profiler: SummariserProfiler = None,
 ):
     """
     Processes a specific day of data and puts the journey summaries in the corresponding
@@ -256,8 +317,12 @@ def process_day(
         End time of the day to process
     chunk_size : int (default 1)
         Number of hours to process each loop iteration
+    profiler : SummariserProfiler (default None)
+        Profiler to record each chunk with. Nothing is recorded if not given.
 
     """
+    if profiler is None:
+        profiler = SummariserProfiler()
     print(start_dt)
     print(end_dt)
     # To allow this to be done on lower memory machines, we'll now do journeys hour by hour.
@@ -275,41 +340,926 @@ def process_day(
     )
     for start_hour, end_hour in zip(day_rrule, offset_day_rrule):
         print("{} to {}".format(start_hour, end_hour))
-        hour_bus_locs_qry = (
-            db_session.query(BusLocation)
-            .filter(
-                and_(
-                    #         BusLocation.line_name == '8',
-                    BusLocation.origin_aimed_departure_time >= start_hour,
-                    BusLocation.origin_aimed_departure_time < end_hour,
-                )
+        with profiler.chunk(start_hour, end_hour):
+            process_chunk(db_session, start_hour, end_hour, profiler)
+
+
+def process_chunk(
+    db_session: Session,
+    start_hour: datetime,
+    end_hour: datetime,
+    profiler: SummariserProfiler,
+):
+    """
+    Summarises the journeys departing in a chunk of time and puts them in the
+    journey summary table, recording each stage with the profiler.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session
+    start_hour : datetime
+        Start time of the chunk
+    end_hour : datetime
+        End time of the chunk
+    profiler : SummariserProfiler
+        Profiler to record the stages with.
+
+    """
+    hour_bus_locs_qry = (
+        db_session.query(BusLocation)
+        .filter(
+            and_(
+                #         BusLocation.line_name == '8',
+                BusLocation.origin_aimed_departure_time >= start_hour,
+                BusLocation.origin_aimed_departure_time < end_hour,
             )
-            .order_by(BusLocation.id.asc())
         )
+        .order_by(BusLocation.id.asc())
+    )
+    with profiler.stage("read_sql") as record:
         hour_bus_locs_df = pd.read_sql(
             hour_bus_locs_qry.statement, hour_bus_locs_qry.session.bind
         )
-        if hour_bus_locs_df.shape[0] > 1:
-            hour_summaries_df = convert_locations_to_journey_summaries(hour_bus_locs_df)
+        record["rows_out"] = hour_bus_locs_df.shape[0]
 
-            if hour_summaries_df is not None:
-                session.bulk_insert_mappings(
-                    JourneySummary, hour_summaries_df.to_dict(orient="records")
-                )
-                session.commit()
-            else:
-                print(
-                    "Not enough bus locations to summaries in time period {} to {}".format(
-                        start_hour, end_hour
-                    )
-                )
-        else:
-            print(
-                "No valid journeys in time period {} to {}".format(start_hour, end_hour)
+    if hour_bus_locs_df.shape[0] <= 1:
+        print("No valid journeys in time period {} to {}".format(start_hour, end_hour))
+        return
+
+    # As in convert_locations_to_journey_summaries, but split up so each stage
+    # can be profiled
+    with profiler.stage(
+        "preprocess_locations", rows_in=hour_bus_locs_df.shape[0]
+    ) as record:
+        processed_locations_df = preprocess_locations(hour_bus_locs_df)
+        record["rows_out"] = processed_locations_df.shape[0]
+
+    if not (processed_locations_df["journey_key"] >= 0).any():
+        print(
+            "Not enough bus locations to summaries in time period {} to {}".format(
+                start_hour, end_hour
+            )
+        )
+        return
+
+    with profiler.stage(
+        "summarise_all_journeys", rows_in=processed_locations_df.shape[0]
+    ) as record:
+        hour_summaries_df = summarise_all_journeys(processed_locations_df)
+        record["rows_out"] = hour_summaries_df.shape[0]
+
+    with profiler.stage(
+        "bulk_insert_mappings", rows_in=hour_summaries_df.shape[0]
+    ) as record:
+        db_session.bulk_insert_mappings(
+            JourneySummary, hour_summaries_df.to_dict(orient="records")
+        )
+    with profiler.stage("commit", rows_in=hour_summaries_df.shape[0]) as record:
+        db_session.commit()
+
+
+def calculate_steps(locations_df: pd.DataFrame):
+    """
+    Calculates the haversine distance and the time from each report to the one
+    before it in the same journey, for the whole frame at once with numpy. The
+    first report of each journey gets a step of zero.
+
+    Parameters
+    ----------
+    locations_df : pd.DataFrame
+        Bus locations sorted by journey_key then timestamp.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        The step distances in miles and the step times in hours.
+    """
+    lat = np.radians(locations_df["vehicle_lat"].to_numpy())
+    lon = np.radians(locations_df["vehicle_lon"].to_numpy())
+    journey_key = locations_df["journey_key"].to_numpy()
+
+    step_miles = np.zeros(lat.shape[0])
+    step_hrs = np.zeros(lat.shape[0])
+    if lat.shape[0] > 1:
+        a = (
+            np.sin(np.diff(lat) / 2) ** 2
+            + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+        )
+        step_miles[1:] = 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+        step_hrs[1:] = np.diff(locations_df["timestamp"].to_numpy()) / np.timedelta64(
+            1, "h"
+        )
+        # Don't count the jump from the end of one journey to the next
+        new_journey = journey_key[1:] != journey_key[:-1]
+        step_miles[1:][new_journey] = 0
+        step_hrs[1:][new_journey] = 0
+
+    return step_miles, step_hrs
+
+
+def project_to_miles(lats: np.ndarray, lons: np.ndarray, ref_lat: float):
+    """
+    Projects latitudes and longitudes onto a flat plane in miles, scaled at
+    ref_lat. Only used to find nearby points, so the distortion away from
+    ref_lat doesn't matter.
+    """
+    x = EARTH_RADIUS_MILES * np.radians(lons) * np.cos(np.radians(ref_lat))
+    y = EARTH_RADIUS_MILES * np.radians(lats)
+    return x, y
+
+
+def build_reference_paths(
+    locations_df: pd.DataFrame, vertex_spacing_miles: float = 0.01
+) -> pd.DataFrame:
+    """
+    Picks a reference path for each line, direction and origin - the journey
+    which travelled furthest - and resamples it every vertex_spacing_miles.
+    Every journey in the group is measured along this path, so a checkpoint is
+    the same place for every bus.
+
+    Parameters
+    ----------
+    locations_df : pd.DataFrame
+        Bus locations sorted by journey and time, with travelled_miles, the
+        distance travelled since each journey's first report.
+    vertex_spacing_miles : float (default 0.01)
+        Distance between the resampled points of each path.
+
+    Returns
+    -------
+    pd.DataFrame
+        The headway group columns, then one row per path vertex with route_id,
+        ref_progress_miles, vehicle_lat and vehicle_lon.
+    """
+    journey_lengths = locations_df.groupby("journey_key").agg(
+        travelled_miles=("travelled_miles", "max"),
+        line_ref=("line_ref", "first"),
+        direction_ref=("direction_ref", "first"),
+        origin_ref=("origin_ref", "first"),
+    )
+    reference_journeys = (
+        journey_lengths.sort_values(by="travelled_miles")
+        .groupby(HEADWAY_GROUP_COLUMNS)
+        .tail(1)
+        .reset_index()
+    )
+    reference_journeys["route_id"] = np.arange(reference_journeys.shape[0])
+    route_ids = reference_journeys.set_index("journey_key")["route_id"]
+
+    paths = []
+    for journey_key, journey_df in locations_df[
+        locations_df["journey_key"].isin(route_ids.index)
+    ].groupby("journey_key"):
+        travelled = journey_df["travelled_miles"].to_numpy()
+        ref_progress = np.arange(0, travelled[-1] + vertex_spacing_miles, vertex_spacing_miles)
+        paths.append(
+            pd.DataFrame(
+                {
+                    "route_id": route_ids[journey_key],
+                    "ref_progress_miles": ref_progress,
+                    "vehicle_lat": np.interp(
+                        ref_progress, travelled, journey_df["vehicle_lat"].to_numpy()
+                    ),
+                    "vehicle_lon": np.interp(
+                        ref_progress, travelled, journey_df["vehicle_lon"].to_numpy()
+                    ),
+                }
+            )
+        )
+
+    paths_df = pd.concat(paths, ignore_index=True)
+    return paths_df.merge(
+        reference_journeys[HEADWAY_GROUP_COLUMNS + ["route_id"]], on="route_id"
+    )
+
+
+def project_onto_reference_paths(
+    locations_df: pd.DataFrame,
+    paths_df: pd.DataFrame,
+    match_radius_miles: float = 0.05,
+    drift_miles: float = 0.25,
+    drift_fraction: float = 0.1,
+    chunk_rows: int = 100000,
+) -> np.ndarray:
+    """
+    Finds how far along its route's reference path each report is, from the
+    nearest path vertex within match_radius_miles. Rather than comparing every
+    report with every vertex, both are bucketed into a grid of
+    match_radius_miles cells and only neighbouring cells are compared.
+
+    Where a route passes the same place twice, e.g. a circular route which
+    starts and ends at the same stop, a report is near more than one part of
+    the path. So reports are only matched to vertices close to where the
+    journey's own distance travelled puts it: its first matched report takes
+    the earliest vertex in range, which fixes the journey's offset along the
+    path, and later reports must be within drift_miles plus drift_fraction of
+    the distance travelled of that offset plus travelled_miles.
+
+    Parameters
+    ----------
+    locations_df : pd.DataFrame
+        Bus locations sorted by journey and time, with route_id and
+        travelled_miles.
+    paths_df : pd.DataFrame
+        Reference paths, as prepared by build_reference_paths.
+    match_radius_miles : float (default 0.05)
+        Reports further than this from their route's path aren't matched.
+    drift_miles : float (default 0.25)
+        How far a match can be from the expected progress.
+    drift_fraction : float (default 0.1)
+        How far a match can be from the expected progress, as a fraction of the
+        distance travelled, as GPS noise builds up in travelled_miles.
+    chunk_rows : int (default 100000)
+        Number of reports to match at once, to bound memory use. Each report
+        has around 20 candidate vertices at the default spacing.
+
+    Returns
+    -------
+    np.ndarray
+        The progress along the reference path of each report, or NaN if it
+        wasn't near the path.
+    """
+    ref_lat = paths_df["vehicle_lat"].mean()
+
+    vertex_x, vertex_y = project_to_miles(
+        paths_df["vehicle_lat"].to_numpy(), paths_df["vehicle_lon"].to_numpy(), ref_lat
+    )
+    vertices = pd.DataFrame(
+        {
+            "route_id": paths_df["route_id"].to_numpy(),
+            "ref_progress_miles": paths_df["ref_progress_miles"].to_numpy(),
+            "vertex_x": vertex_x,
+            "vertex_y": vertex_y,
+            "cell_x": np.floor(vertex_x / match_radius_miles).astype(int),
+            "cell_y": np.floor(vertex_y / match_radius_miles).astype(int),
+        }
+    )
+    # Register each vertex in its neighbouring cells too, so each report only
+    # needs to look in its own cell
+    vertices = pd.concat(
+        [
+            vertices.assign(
+                cell_x=vertices["cell_x"] + dx, cell_y=vertices["cell_y"] + dy
+            )
+            for dx in (-1, 0, 1)
+            for dy in (-1, 0, 1)
+        ],
+        ignore_index=True,
+    )
+
+    report_x, report_y = project_to_miles(
+        locations_df["vehicle_lat"].to_numpy(),
+        locations_df["vehicle_lon"].to_numpy(),
+        ref_lat,
+    )
+    reports = pd.DataFrame(
+        {
+            "row": np.arange(locations_df.shape[0]),
+            "journey_key": locations_df["journey_key"].to_numpy(),
+            "travelled_miles": locations_df["travelled_miles"].to_numpy(),
+            "route_id": locations_df["route_id"].to_numpy(),
+            "report_x": report_x,
+            "report_y": report_y,
+            "cell_x": np.floor(report_x / match_radius_miles).astype(int),
+            "cell_y": np.floor(report_y / match_radius_miles).astype(int),
+        }
+    )
+
+    progress = np.full(locations_df.shape[0], np.nan)
+    # Offset along the reference path of each journey's first matched report
+    journey_offsets = pd.Series(dtype=float)
+    for start in range(0, reports.shape[0], chunk_rows):
+        candidates = reports.iloc[start : start + chunk_rows].merge(
+            vertices, on=["route_id", "cell_x", "cell_y"]
+        )
+        candidates["dist"] = np.hypot(
+            candidates["report_x"] - candidates["vertex_x"],
+            candidates["report_y"] - candidates["vertex_y"],
+        )
+        candidates = candidates[candidates["dist"] <= match_radius_miles]
+
+        # Journeys are sorted by time, so the first matched row of a journey we
+        # haven't seen yet is its first matched report
+        new_journeys = candidates[
+            ~candidates["journey_key"].isin(journey_offsets.index)
+        ]
+        first_rows = new_journeys[
+            new_journeys["row"]
+            == new_journeys.groupby("journey_key")["row"].transform("min")
+        ]
+        first_matches = first_rows.groupby("journey_key").agg(
+            ref_progress_miles=("ref_progress_miles", "min"),
+            travelled_miles=("travelled_miles", "first"),
+        )
+        journey_offsets = pd.concat(
+            [
+                journey_offsets,
+                first_matches["ref_progress_miles"] - first_matches["travelled_miles"],
+            ]
+        )
+
+        expected_progress = (
+            candidates["journey_key"].map(journey_offsets)
+            + candidates["travelled_miles"]
+        )
+        candidates = candidates[
+            (candidates["ref_progress_miles"] - expected_progress).abs()
+            <= drift_miles + drift_fraction * candidates["travelled_miles"]
+        ]
+        nearest = candidates.loc[candidates.groupby("row")["dist"].idxmin()]
+        progress[nearest["row"].to_numpy()] = nearest["ref_progress_miles"].to_numpy()
+
+    return progress
+
+
+def calculate_journey_progress(
+    locations_df: pd.DataFrame,
+    vertex_spacing_miles: float = 0.01,
+    match_radius_miles: float = 0.05,
+) -> pd.DataFrame:
+    """
+    Adds how far along its route each report is, in miles, as progress_miles.
+
+    Progress is measured along a shared reference path for each line, direction
+    and origin (see build_reference_paths), so it means the same place for every
+    journey, even those which started reporting part way along. A journey's
+    progress never goes backwards, so GPS jitter while waiting doesn't count,
+    and reports are only matched to the part of the path the journey's own
+    distance travelled says it is on (see project_onto_reference_paths), so a
+    bus waiting at the stop a circular route starts and ends at isn't taken to
+    have finished. Reports too far from the reference path are dropped.
+
+    Parameters
+    ----------
+    locations_df : pd.DataFrame
+        Bus locations, as prepared by preprocess_locations.
+    vertex_spacing_miles : float (default 0.01)
+        Distance between the points of each reference path.
+    match_radius_miles : float (default 0.05)
+        Reports further than this from their reference path are dropped.
+
+    Returns
+    -------
+    pd.DataFrame
+        The matched locations of journeys with a valid key, sorted by journey
+        and time, with progress_miles added.
+    """
+    locations_df = locations_df[
+        (locations_df["journey_key"] >= 0)
+        & locations_df[HEADWAY_GROUP_COLUMNS].notna().all(axis=1)
+    ].sort_values(by=["journey_key", "timestamp", "id"])
+    if locations_df.shape[0] == 0:
+        return locations_df.assign(progress_miles=np.nan)
+
+    step_miles, _ = calculate_steps(locations_df)
+    locations_df["travelled_miles"] = step_miles
+    locations_df["travelled_miles"] = locations_df.groupby("journey_key")[
+        "travelled_miles"
+    ].cumsum()
+
+    paths_df = build_reference_paths(locations_df, vertex_spacing_miles)
+    locations_df = locations_df.merge(
+        paths_df[HEADWAY_GROUP_COLUMNS + ["route_id"]].drop_duplicates(),
+        on=HEADWAY_GROUP_COLUMNS,
+    )
+    locations_df["progress_miles"] = project_onto_reference_paths(
+        locations_df, paths_df, match_radius_miles
+    )
+    locations_df = locations_df[locations_df["progress_miles"].notna()].copy()
+    locations_df["progress_miles"] = locations_df.groupby("journey_key")[
+        "progress_miles"
+    ].cummax()
+
+    return locations_df.drop(["travelled_miles", "route_id"], axis=1)
+
+
+def calculate_checkpoint_passages(
+    progress_df: pd.DataFrame, checkpoint_spacing_miles: float = 0.25
+) -> pd.DataFrame:
+    """
+    Works out when each journey passed each checkpoint, where checkpoints are
+    spaced every checkpoint_spacing_miles along the route's reference path.
+    Journeys are only given the checkpoints between their first and last
+    reports. Passage times are interpolated between the reports either side,
+    found with as-of joins on progress rather than comparing every pair.
+
+    Parameters
+    ----------
+    progress_df : pd.DataFrame
+        Bus locations, as prepared by calculate_journey_progress.
+    checkpoint_spacing_miles : float (default 0.25)
+        Distance between checkpoints.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per journey per checkpoint passed, with passage_time.
+    """
+    journeys = progress_df.groupby("journey_key").agg(
+        min_progress=("progress_miles", "min"),
+        max_progress=("progress_miles", "max"),
+        line_ref=("line_ref", "first"),
+        direction_ref=("direction_ref", "first"),
+        origin_ref=("origin_ref", "first"),
+        vehicle_ref=("vehicle_ref", "first"),
+    )
+    first_checkpoint = np.ceil(
+        journeys["min_progress"] / checkpoint_spacing_miles
+    ).astype(int)
+    last_checkpoint = np.floor(
+        journeys["max_progress"] / checkpoint_spacing_miles
+    ).astype(int)
+    num_checkpoints = (last_checkpoint - first_checkpoint + 1).clip(lower=0)
+    checkpoints = journeys.loc[
+        journeys.index.repeat(num_checkpoints)
+    ].reset_index()
+    checkpoints["checkpoint_miles"] = (
+        first_checkpoint.repeat(num_checkpoints).to_numpy()
+        + checkpoints.groupby("journey_key").cumcount().to_numpy()
+    ) * checkpoint_spacing_miles
+    checkpoints = checkpoints.sort_values(by="checkpoint_miles")
+
+    # Join on progress, keeping a copy of it so we can interpolate
+    reports = progress_df[["journey_key", "progress_miles", "timestamp"]].sort_values(
+        by="progress_miles"
+    )
+    reports["checkpoint_miles"] = reports["progress_miles"]
+    # The last report at or before each checkpoint, and the first one at or after
+    before = pd.merge_asof(
+        checkpoints[["journey_key", "checkpoint_miles"]],
+        reports,
+        on="checkpoint_miles",
+        by="journey_key",
+        direction="backward",
+    )
+    after = pd.merge_asof(
+        checkpoints[["journey_key", "checkpoint_miles"]],
+        reports,
+        on="checkpoint_miles",
+        by="journey_key",
+        direction="forward",
+    )
+
+    span = (after["progress_miles"] - before["progress_miles"]).to_numpy()
+    frac = np.divide(
+        checkpoints["checkpoint_miles"].to_numpy()
+        - before["progress_miles"].to_numpy(),
+        span,
+        out=np.ones(span.shape[0]),
+        where=span > 0,
+    )
+    checkpoints["passage_time"] = (
+        before["timestamp"] + (after["timestamp"] - before["timestamp"]) * frac
+    ).to_numpy()
+    return checkpoints.drop(["min_progress", "max_progress"], axis=1)
+
+
+def calculate_headways(
+    passages_df: pd.DataFrame, bunching_threshold_mins: float = 2.0
+) -> pd.DataFrame:
+    """
+    Calculates the headway at each checkpoint between each bus and the one in
+    front of it on the same line, direction and origin.
+
+    Parameters
+    ----------
+    passages_df : pd.DataFrame
+        Checkpoint passages, as prepared by calculate_checkpoint_passages.
+    bunching_threshold_mins : float (default 2.0)
+        Headways shorter than this count as bunching.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per checkpoint passage which has a bus in front of it.
+    """
+    group_columns = HEADWAY_GROUP_COLUMNS + ["checkpoint_miles"]
+    headways_df = passages_df.sort_values(by=group_columns + ["passage_time"])
+    # Every row is compared with the one before it, so only keep rows where
+    # that row is in the same group
+    same_group = (
+        headways_df[group_columns] == headways_df[group_columns].shift()
+    ).all(axis=1)
+
+    headways_df["leading_vehicle_ref"] = headways_df["vehicle_ref"].shift()
+    headways_df["headway_mins"] = (
+        headways_df["passage_time"].diff().dt.total_seconds() / 60
+    )
+    headways_df = headways_df[same_group.to_numpy()].copy()
+    headways_df["is_bunched"] = headways_df["headway_mins"] < bunching_threshold_mins
+    headways_df["hour"] = headways_df["passage_time"].dt.floor("h")
+
+    return headways_df[
+        group_columns
+        + [
+            "hour",
+            "passage_time",
+            "vehicle_ref",
+            "leading_vehicle_ref",
+            "headway_mins",
+            "is_bunched",
+        ]
+    ]
+
+
+def process_day_headways(
+    db_session: Session,
+    start_dt: datetime,
+    end_dt: datetime,
+    checkpoint_spacing_miles: float = 0.25,
+    bunching_threshold_mins: float = 2.0,
+    lines_per_slice: int = 50,
+):
+    """
+    Calculates the headways and bunching for a day of data and puts them in the
+    headway table, replacing any already there for that day.
+
+    Unlike process_day this needs the whole day at once, as consecutive buses
+    on a line can depart in different hours. Headways are only compared within
+    a line though, so to keep memory down we work through the day a few lines
+    at a time, only reading the columns we need.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session
+    start_dt : datetime
+        Start time of the day to process
+    end_dt : datetime
+        End time of the day to process
+    checkpoint_spacing_miles : float (default 0.25)
+        Distance between the checkpoints headways are measured at.
+    bunching_threshold_mins : float (default 2.0)
+        Headways shorter than this count as bunching.
+    lines_per_slice : int (default 50)
+        Number of line refs to process each loop iteration.
+
+    """
+    day_filter = and_(
+        BusLocation.origin_aimed_departure_time >= start_dt,
+        BusLocation.origin_aimed_departure_time < end_dt,
+    )
+    line_refs = sorted(
+        line_ref
+        for (line_ref,) in db_session.query(BusLocation.line_ref)
+        .filter(and_(day_filter, BusLocation.line_ref.isnot(None)))
+        .distinct()
+    )
+    if len(line_refs) == 0:
+        print("No valid journeys in time period {} to {}".format(start_dt, end_dt))
+        return
+
+    db_session.query(Headway).filter(Headway.date == start_dt).delete(
+        synchronize_session=False
+    )
+
+    num_headways = 0
+    num_bunched = 0
+    for i in range(0, len(line_refs), lines_per_slice):
+        slice_bus_locs_qry = db_session.query(
+            BusLocation.id,
+            BusLocation.timestamp,
+            BusLocation.line_ref,
+            BusLocation.direction_ref,
+            BusLocation.operator_ref,
+            BusLocation.origin_ref,
+            BusLocation.origin_aimed_departure_time,
+            BusLocation.vehicle_lat,
+            BusLocation.vehicle_lon,
+            BusLocation.vehicle_bearing,
+            BusLocation.vehicle_journey_ref,
+            BusLocation.vehicle_ref,
+        ).filter(
+            and_(
+                day_filter,
+                BusLocation.line_ref.in_(line_refs[i : i + lines_per_slice]),
+            )
+        )
+        slice_bus_locs_df = pd.read_sql(
+            slice_bus_locs_qry.statement, slice_bus_locs_qry.session.bind
+        )
+        if slice_bus_locs_df.shape[0] <= 1:
+            continue
+
+        progress_df = calculate_journey_progress(
+            preprocess_locations(slice_bus_locs_df)
+        )
+        if progress_df.shape[0] == 0:
+            continue
+        passages_df = calculate_checkpoint_passages(
+            progress_df, checkpoint_spacing_miles
+        )
+        headways_df = calculate_headways(passages_df, bunching_threshold_mins)
+        num_headways += headways_df.shape[0]
+        num_bunched += headways_df["is_bunched"].sum()
+
+        headways_df["date"] = start_dt
+        headway_records = headways_df.to_dict(orient="records")
+        for j in range(0, len(headway_records), 100000):
+            db_session.bulk_insert_mappings(Headway, headway_records[j : j + 100000])
+
+    print("{} headways, {} bunched".format(num_headways, num_bunched))
+    # One commit, so a failed run doesn't leave the day half replaced
+    db_session.commit()
+
+
+def calculate_segment_speeds(locations_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Calculates the speed of every segment between consecutive reports of a
+    journey, located at the segment's midpoint and the hour of day it started.
+
+    Parameters
+    ----------
+    locations_df : pd.DataFrame
+        Bus locations, as prepared by preprocess_locations.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per segment with mid_lat, mid_lon, hour_of_day and speed_mph.
+    """
+    locations_df = locations_df[locations_df["journey_key"] >= 0].sort_values(
+        by=["journey_key", "timestamp", "id"]
+    )
+    step_miles, step_hrs = calculate_steps(locations_df)
+
+    # Each step ends at a report, so the segment starts at the one before it.
+    # Steps of zero time include the first report of each journey.
+    valid = step_hrs > 0
+    ends = np.flatnonzero(valid)
+    starts = ends - 1
+    lat = locations_df["vehicle_lat"].to_numpy()
+    lon = locations_df["vehicle_lon"].to_numpy()
+
+    return pd.DataFrame(
+        {
+            "mid_lat": (lat[starts] + lat[ends]) / 2,
+            "mid_lon": (lon[starts] + lon[ends]) / 2,
+            "hour_of_day": locations_df["timestamp"].dt.hour.to_numpy()[starts],
+            "speed_mph": step_miles[valid] / step_hrs[valid],
+        }
+    )
+
+
+def aggregate_speed_cells(
+    segments_df: pd.DataFrame, cell_size: float = 0.01
+) -> pd.DataFrame:
+    """
+    Bins segment speeds into a grid of cell_size degree cells per hour of day,
+    keeping aggregates which can be merged later with merge_speed_cells.
+
+    Parameters
+    ----------
+    segments_df : pd.DataFrame
+        Segment speeds, as prepared by calculate_segment_speeds.
+    cell_size : float (default 0.01)
+        Width and height of each grid cell in degrees.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per cell and hour of day, with count, speed_sum, speed_min,
+        speed_max and speed_histogram.
+    """
+    segments_df = segments_df.assign(
+        lat_idx=np.floor(segments_df["mid_lat"] / cell_size).astype(int),
+        lon_idx=np.floor(segments_df["mid_lon"] / cell_size).astype(int),
+        bucket=np.clip(
+            (segments_df["speed_mph"] // SPEED_HISTOGRAM_BUCKET_MPH).astype(int),
+            0,
+            SPEED_HISTOGRAM_NUM_BUCKETS - 1,
+        ),
+    )
+    cells_df = segments_df.groupby(SPEED_CELL_COLUMNS)["speed_mph"].agg(
+        count="count", speed_sum="sum", speed_min="min", speed_max="max"
+    )
+    histograms = (
+        segments_df.groupby(SPEED_CELL_COLUMNS + ["bucket"])
+        .size()
+        .unstack(fill_value=0)
+        .reindex(columns=range(SPEED_HISTOGRAM_NUM_BUCKETS), fill_value=0)
+    )
+    cells_df["speed_histogram"] = list(histograms.loc[cells_df.index].to_numpy())
+    return cells_df.reset_index()
+
+
+def merge_speed_cells(cells_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merges speed cells with the same position and hour of day, e.g. from
+    different hours of processing or different days.
+
+    Parameters
+    ----------
+    cells_df : pd.DataFrame
+        Speed cells, as prepared by aggregate_speed_cells or read from the
+        speed_cell table.
+
+    Returns
+    -------
+    pd.DataFrame
+        The merged speed cells.
+    """
+    if cells_df.shape[0] == 0:
+        return cells_df
+
+    grouped = cells_df.groupby(SPEED_CELL_COLUMNS)
+    merged_df = grouped.agg(
+        count=("count", "sum"),
+        speed_sum=("speed_sum", "sum"),
+        speed_min=("speed_min", "min"),
+        speed_max=("speed_max", "max"),
+    )
+    merged_df["speed_histogram"] = grouped["speed_histogram"].apply(
+        lambda histograms: np.sum(np.stack(histograms.to_numpy()), axis=0)
+    )
+    return merged_df.reset_index()
+
+
+def histogram_quantile(histogram: np.ndarray, q: float) -> float:
+    """
+    Approximates a speed quantile from a speed histogram, taking the midpoint of
+    the bucket the quantile falls in.
+    """
+    cumulative = np.cumsum(histogram)
+    bucket = np.searchsorted(cumulative, q * cumulative[-1])
+    return (bucket + 0.5) * SPEED_HISTOGRAM_BUCKET_MPH
+
+
+def process_day_speed_cells(
+    db_session: Session,
+    start_dt: datetime,
+    end_dt: datetime,
+    cell_size: float = 0.01,
+    chunk_size: int = 1,
+):
+    """
+    Bins a day of segment speeds into the speed_cell table, replacing any cells
+    already there for that day and cell size. As in process_day
+    we work through the day a few hours at a time, merging the cells as we go,
+    so this is fine on lower memory machines.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session
+    start_dt : datetime
+        Start time of the day to process
+    end_dt : datetime
+        End time of the day to process
+    cell_size : float (default 0.01)
+        Width and height of each grid cell in degrees.
+    chunk_size : int (default 1)
+        Number of hours to process each loop iteration
+
+    """
+    day_rrule = dateutil.rrule.rrule(
+        freq=dateutil.rrule.HOURLY,
+        interval=chunk_size,
+        dtstart=start_dt,
+        until=end_dt - datetime.timedelta(hours=chunk_size),
+    )
+    offset_day_rrule = dateutil.rrule.rrule(
+        freq=dateutil.rrule.HOURLY,
+        interval=chunk_size,
+        dtstart=start_dt + datetime.timedelta(hours=chunk_size),
+        until=end_dt,
+    )
+    day_cells = []
+    for start_hour, end_hour in zip(day_rrule, offset_day_rrule):
+        hour_bus_locs_qry = db_session.query(
+            BusLocation.id,
+            BusLocation.timestamp,
+            BusLocation.line_ref,
+            BusLocation.direction_ref,
+            BusLocation.operator_ref,
+            BusLocation.origin_aimed_departure_time,
+            BusLocation.vehicle_lat,
+            BusLocation.vehicle_lon,
+            BusLocation.vehicle_bearing,
+            BusLocation.vehicle_journey_ref,
+        ).filter(
+            and_(
+                BusLocation.origin_aimed_departure_time >= start_hour,
+                BusLocation.origin_aimed_departure_time < end_hour,
             )
+        )
+        hour_bus_locs_df = pd.read_sql(
+            hour_bus_locs_qry.statement, hour_bus_locs_qry.session.bind
+        )
+        if hour_bus_locs_df.shape[0] > 1:
+            segments_df = calculate_segment_speeds(
+                preprocess_locations(hour_bus_locs_df)
+            )
+            day_cells.append(aggregate_speed_cells(segments_df, cell_size))
+
+    if len(day_cells) == 0:
+        print("No speed cells in time period {} to {}".format(start_dt, end_dt))
+        return
 
+    day_cells_df = merge_speed_cells(pd.concat(day_cells))
+    day_cells_df["date"] = start_dt
+    day_cells_df["cell_size"] = cell_size
+    day_cells_df["speed_histogram"] = day_cells_df["speed_histogram"].apply(
+        lambda histogram: [int(count) for count in histogram]
+    )
+    print("{} speed cells".format(day_cells_df.shape[0]))
 
-def process_all_in_db(db_session: Session):
+    db_session.query(SpeedCell).filter(
+        and_(SpeedCell.date == start_dt, SpeedCell.cell_size == cell_size)
+    ).delete(synchronize_session=False)
+    db_session.bulk_insert_mappings(SpeedCell, day_cells_df.to_dict(orient="records"))
+    db_session.commit()
+
+
+def generate_speed_heatmap(
+    db_session: Session,
+    start_dt: datetime,
+    num_days: int = 28,
+    cell_size: float = 0.01,
+) -> str:
+    """
+    Merges the stored speed cells for the num_days up to start_dt into a
+    compact heatmap, without going back to the raw locations.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session.
+    start_dt : datetime
+        The last day to include.
+    num_days : int (default 28)
+        Number of days to include.
+    cell_size : float (default 0.01)
+        Size of the cells to use - only cells stored with this size are read.
+
+    Returns
+    -------
+    str
+        The heatmap as JSON, with a list of columns and a row per cell.
+    """
+    cells_qry = db_session.query(SpeedCell).filter(
+        and_(
+            SpeedCell.cell_size == cell_size,
+            SpeedCell.date <= start_dt,
+            SpeedCell.date > start_dt - datetime.timedelta(days=num_days),
+        )
+    )
+    cells_df = merge_speed_cells(
+        pd.read_sql(cells_qry.statement, cells_qry.session.bind)
+    )
+
+    columns = [
+        "lat",
+        "lon",
+        "hour_of_day",
+        "count",
+        "speed_mean_mph",
+        "speed_min_mph",
+        "speed_max_mph",
+        "speed_p10_mph",
+        "speed_med_mph",
+        "speed_p90_mph",
+    ]
+    rows = []
+    for cell in cells_df.itertuples():
+        histogram = np.asarray(cell.speed_histogram)
+        rows.append(
+            [
+                round(cell.lat_idx * cell_size, 5),
+                round(cell.lon_idx * cell_size, 5),
+                int(cell.hour_of_day),
+                int(cell.count),
+                round(cell.speed_sum / cell.count, 2),
+                round(cell.speed_min, 2),
+                round(cell.speed_max, 2),
+                histogram_quantile(histogram, 0.1),
+                histogram_quantile(histogram, 0.5),
+                histogram_quantile(histogram, 0.9),
+            ]
+        )
+
+    return json.dumps(
+        {
+            "cell_size": cell_size,
+            "num_days": num_days,
+            "start": start_dt.strftime("%Y-%m-%d"),
+            "columns": columns,
+            "rows": rows,
+        },
+        separators=(",", ":"),
+    )
+
+
+def process_all_in_db(
+    db_session: Session,
+    headways: bool = False,
+    checkpoint_spacing_miles: float = 0.25,
+    bunching_threshold_mins: float = 2.0,
+    speed_cells: bool = False,
+    cell_size: float = 0.01,
+    profiler: SummariserProfiler = None,
+):
     """
     This processes all bus journeys in the database up to the end of the previous full day
     and inserts them into the JourneySummary table.
@@ -318,6 +1268,18 @@ def process_all_in_db(db_session: Session):
     ----------
     db_session : Session
         An SQLAlchemy database session.
+    headways : bool (default False)
+        Whether to also calculate headways for each day.
+    checkpoint_spacing_miles : float (default 0.25)
+        Distance between the checkpoints headways are measured at.
+    bunching_threshold_mins : float (default 2.0)
+        Headways shorter than this count as bunching.
+    speed_cells : bool (default False)
+        Whether to also bin segment speeds into speed cells for each day.
+    cell_size : float (default 0.01)
+        Width and height of each speed cell in degrees.
+    profiler : SummariserProfiler (default None)
+        Profiler to record each chunk with. Nothing is recorded if not given.
 
     """
     # Get first and last entries of departure times
@@ -354,7 +1316,17 @@ def process_all_in_db(db_session: Session):
 
     for day_start, day_end in zip(first_rrule, second_rrule):
         print("{} to {}".format(day_start, day_end))
-        process_day(db_session, day_start, day_end)
+        process_day(db_session, day_start, day_end, profiler=profiler)
+        if headways:
+            process_day_headways(
+                db_session,
+                day_start,
+                day_end,
+                checkpoint_spacing_miles,
+                bunching_threshold_mins,
+            )
+        if speed_cells:
+            process_day_speed_cells(db_session, day_start, day_end, cell_size)
         # break
 
 
@@ -435,6 +1407,10 @@ def generate_daily_summary(
 
 
 if __name__ == "__main__":
+    # Only needed when run as a script, so the functions above can be imported
+    # without a credentials file
+    import credentials
+
     parser = argparse.ArgumentParser(
         description="Tool to summarise bus journeys and push daily statistics to an S3 bucket.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -455,6 +1431,58 @@ if __name__ == "__main__":
         action="store_true",
         help="Produce a summary JSON file and push it to an S3 bucket.",
     )
+    parser.add_argument(
+        "--headways",
+        action="store_true",
+        help="Also calculate headways and bunching for each processed day.",
+    )
+    parser.add_argument(
+        "--checkpoint_spacing",
+        type=float,
+        default=0.25,
+        help="Distance in miles between the points along each route that headways are measured at.",
+    )
+    parser.add_argument(
+        "--bunching_threshold",
+        type=float,
+        default=2.0,
+        help="Headways shorter than this many minutes count as bunching.",
+    )
+    parser.add_argument(
+        "--speed_cells",
+        action="store_true",
+        help="Also bin segment speeds into a grid for each processed day. With --aws, push a speed heatmap too.",
+    )
+    parser.add_argument(
+        "--cell_size",
+        type=float,
+        default=0.01,
+        help="Width and height of each speed grid cell in degrees.",
+    )
+    parser.add_argument(
+        "--heatmap_days",
+        type=int,
+        default=28,
+        help="Number of days of speed cells to merge into the heatmap.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Record the time, rows and peak memory of each stage of each chunk and write a JSON report to this path.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="With --profile, also run each chunk under cProfile and keep the stats for the slowest chunks in this directory.",
+    )
+    parser.add_argument(
+        "--profile_slowest",
+        type=int,
+        default=3,
+        help="Number of slowest chunks to keep cProfile stats for.",
+    )
     args = parser.parse_args()
 
     engine = create_engine(
@@ -470,29 +1498,62 @@ if __name__ == "__main__":
     DBSession = sessionmaker(bind=engine)
     session = DBSession()
 
-    if args.process_all:
-        process_all_in_db(session)
+    # Each chunk is also logged next to the report as it finishes
+    chunk_log_path = None
+    if args.profile is not None:
+        chunk_log_path = Path(args.profile).with_suffix(".chunks.jsonl")
+    profiler = SummariserProfiler(
+        enabled=args.profile is not None,
+        profile_dir=args.profile_dir,
+        num_slowest=args.profile_slowest,
+        chunk_log_path=chunk_log_path,
+    )
 
-    if args.process_yesterday:
-        today = datetime.date.today()
-        start_dt = datetime.datetime(today.year, today.month, today.day - 1)
-        end_dt = datetime.datetime(today.year, today.month, today.day)
-        process_day(session, start_dt, end_dt)
+    # Write the report even if the run fails part way, so we can see why
+    try:
+        if args.process_all:
+            process_all_in_db(
+                session,
+                headways=args.headways,
+                checkpoint_spacing_miles=args.checkpoint_spacing,
+                bunching_threshold_mins=args.bunching_threshold,
+                speed_cells=args.speed_cells,
+                cell_size=args.cell_size,
+                profiler=profiler,
+            )
 
-    if args.aws:
-        daily_summary_json = generate_daily_summary(
-            session, datetime.datetime.now() - datetime.timedelta(days=1)
-        )
+        if args.process_yesterday:
+            today = datetime.date.today()
+            start_dt = datetime.datetime(today.year, today.month, today.day - 1)
+            end_dt = datetime.datetime(today.year, today.month, today.day)
+            process_day(session, start_dt, end_dt, profiler=profiler)
+            if args.headways:
+                process_day_headways(
+                    session,
+                    start_dt,
+                    end_dt,
+                    checkpoint_spacing_miles=args.checkpoint_spacing,
+                    bunching_threshold_mins=args.bunching_threshold,
+                )
+            if args.speed_cells:
+                process_day_speed_cells(session, start_dt, end_dt, args.cell_size)
 
-        s3 = boto3.resource("s3")
-        upload_obj = BytesIO()
-        json_comp = gzip.GzipFile(None, "w", 9, upload_obj)
-        json_comp.write(daily_summary_json.encode("utf-8"))
-        json_comp.close()
-        s3.Bucket(credentials.S3_BUCKET_NAME).put_object(
-            Key="daily_summary.json",
-            Body=upload_obj.getvalue(),
-            ACL="public-read",
-            ContentType="application/json",
-            ContentEncoding="gzip",
-        )
+        if args.aws:
+            daily_summary_json = generate_daily_summary(
+                session, datetime.datetime.now() - datetime.timedelta(days=1)
+            )
+
+            s3 = boto3.resource("s3")
+            push_json_to_s3(s3, "daily_summary.json", daily_summary_json)
+
+            if args.speed_cells:
+                speed_heatmap_json = generate_speed_heatmap(
+                    session,
+                    datetime.datetime.now() - datetime.timedelta(days=1),
+                    num_days=args.heatmap_days,
+                    cell_size=args.cell_size,
+                )
+                push_json_to_s3(s3, "speed_heatmap.json", speed_heatmap_json)
+    finally:
+        if args.profile is not None:
+            profiler.write_report(args.profile)
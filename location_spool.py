@@ -0,0 +1,325 @@
+import os
+import gzip
+import json
+import time
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where only one collector should use a spool
+    fcntl = None
+
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError
+from sqlalchemy.orm import Session
+
+from bus_data_models import BusLocation, bus_location_mapping
+
+
+class LocationSpool:
+    """
+    An append-only local spool for bus location reports which couldn't be
+    written to the database, e.g. because it is down or overloaded.
+
+    Reports are stored as gzipped JSON lines in segment files, oldest first.
+    Each batch is written as its own gzip member and synced to disk, so a crash
+    loses at most the batch being written. Once the database is back, the
+    segments are drained with large bulk inserts and deleted.
+
+    If a segment fails to insert for any reason other than the database being
+    unavailable, its reports are retried one at a time and any which still
+    fail, e.g. a line_ref too long for its column, are moved to a failed/
+    segment so they can't block the spool.
+
+    Several collectors on one host can share a spool directory: writing and
+    draining each segment both hold an exclusive lock on the directory, so one
+    collector can't delete a segment another is still appending to, or insert
+    a segment another is already draining.
+
+    Segments are read back a batch at a time, so draining doesn't hold a whole
+    segment in memory. Note that a crash between inserting a segment and
+    deleting it will insert those reports twice. The summariser drops
+    duplicate reports, so this is harmless.
+
+    Parameters
+    ----------
+    spool_dir : Path
+        Directory to keep the spool segments in.
+    max_bytes : int (default 500MB)
+        Maximum total size of the spool. Batches which would take the spool
+        over this are dropped.
+    segment_bytes : int (default 1MB)
+        Size at which to start a new segment file. Draining stops between
+        segments, so this also bounds how far a drain can overshoot
+        max_reports.
+    """
+
+    def __init__(
+        self,
+        spool_dir: Path,
+        max_bytes: int = 500 * 1024 * 1024,
+        segment_bytes: int = 1024 * 1024,
+    ):
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.current_segment = None
+
+        # Metrics, logged by log_stats
+        self.num_spooled = 0
+        self.num_drained = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+
+    @staticmethod
+    def is_outage(error: Exception) -> bool:
+        """Returns True if an error means the database is unavailable, rather
+        than that the data is bad."""
+        return isinstance(error, (OperationalError, InterfaceError, DisconnectionError))
+
+    @contextmanager
+    def locked(self):
+        """Holds an exclusive lock on the spool directory, shared by every
+        process using it."""
+        if fcntl is None:
+            yield
+            return
+        with open(self.spool_dir / ".lock", "w") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def segments(self) -> list:
+        """Returns the spool segments, oldest first."""
+        return sorted(self.spool_dir.glob("spool_*.jsonl.gz"))
+
+    def size_bytes(self) -> int:
+        """Returns the total size of the spool on disk."""
+        return sum(segment.stat().st_size for segment in self.segments())
+
+    def is_empty(self) -> bool:
+        return len(self.segments()) == 0
+
+    def write(self, bus_loc_list: list):
+        """
+        Appends a batch of bus location reports to the spool.
+
+        Parameters
+        ----------
+        bus_loc_list : list
+            A list of bus location report dictionaries, as prepared by
+            convert_activity_to_dict.
+
+        """
+        if len(bus_loc_list) == 0:
+            return
+
+        data = "".join(json.dumps(report) + "\n" for report in bus_loc_list)
+        compressed = gzip.compress(data.encode("utf-8"))
+
+        with self.locked():
+            if self.size_bytes() + len(compressed) > self.max_bytes:
+                self.num_dropped += len(bus_loc_list)
+                logging.error(
+                    "Spool is full, dropping {} reports".format(len(bus_loc_list))
+                )
+                return
+
+            if (
+                self.current_segment is None
+                or not self.current_segment.exists()
+                or self.current_segment.stat().st_size >= self.segment_bytes
+            ):
+                # Zero padded so the segments sort oldest first, with the
+                # process ID so collectors sharing the spool never clash
+                self.current_segment = self.spool_dir / "spool_{:020d}_{}.jsonl.gz".format(
+                    int(time.time() * 1e6), os.getpid()
+                )
+
+            # Concatenated gzip members are still a valid gzip file
+            with open(self.current_segment, "ab") as f:
+                f.write(compressed)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.num_spooled += len(bus_loc_list)
+
+    def read_segment(self, segment: Path, batch_size: int = 10000):
+        """
+        Reads the reports from a segment, a batch at a time. If the last batch
+        was only partly written, e.g. because of a crash, whatever can be read
+        is returned.
+
+        Parameters
+        ----------
+        segment : Path
+            The segment to read.
+        batch_size : int (default 10000)
+            Number of reports per batch.
+
+        Returns
+        -------
+        generator of list
+            Lists of up to batch_size bus location report dictionaries.
+        """
+        bus_loc_list = []
+        try:
+            with gzip.open(segment, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        bus_loc_list.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logging.warning("Skipping corrupt line in {}".format(segment))
+                        continue
+                    if len(bus_loc_list) >= batch_size:
+                        yield bus_loc_list
+                        bus_loc_list = []
+        except (EOFError, OSError) as e:
+            logging.warning("Segment {} is truncated: {}".format(segment, e))
+        if len(bus_loc_list) > 0:
+            yield bus_loc_list
+
+    def drain(
+        self,
+        db_session: Session,
+        batch_size: int = 10000,
+        max_reports: int = 500000,
+    ) -> int:
+        """
+        Inserts spooled reports into the database with bulk inserts, oldest
+        segment first, deleting each segment once it is committed. Stops at the
+        first error, leaving the remaining segments for next time.
+
+        Parameters
+        ----------
+        db_session : Session
+            An SQLAlchemy database session.
+        batch_size : int (default 10000)
+            Number of reports to insert per statement.
+        max_reports : int (default 500000)
+            Stop after roughly this many reports, so live polling isn't held
+            up for too long.
+
+        Returns
+        -------
+        int
+            The number of reports inserted.
+        """
+        num_inserted = 0
+        for segment in self.segments():
+            if num_inserted >= max_reports:
+                break
+
+            # Lock per segment, so other collectors can keep spooling while we
+            # drain
+            with self.locked():
+                if not segment.exists():
+                    # Already drained by another collector
+                    continue
+                try:
+                    num_segment_inserted = 0
+                    for bus_loc_list in self.read_segment(segment, batch_size):
+                        db_session.bulk_insert_mappings(
+                            BusLocation,
+                            [bus_location_mapping(report) for report in bus_loc_list],
+                        )
+                        num_segment_inserted += len(bus_loc_list)
+                    db_session.commit()
+                except Exception as e:
+                    db_session.rollback()
+                    if self.is_outage(e):
+                        logging.error("Error draining spool: {}".format(e))
+                        break
+                    logging.warning(
+                        "Segment {} failed to insert, retrying reports one at a time: {}".format(
+                            segment, e
+                        )
+                    )
+                    try:
+                        num_segment_inserted = self.insert_individually(
+                            db_session, segment, batch_size
+                        )
+                    except Exception as e:
+                        db_session.rollback()
+                        logging.error("Error draining spool: {}".format(e))
+                        break
+
+                segment.unlink()
+            if segment == self.current_segment:
+                self.current_segment = None
+            num_inserted += num_segment_inserted
+
+        self.num_drained += num_inserted
+        return num_inserted
+
+    def insert_individually(
+        self, db_session: Session, segment: Path, batch_size: int = 10000
+    ) -> int:
+        """
+        Inserts a segment's reports one at a time, each in its own savepoint,
+        and moves those which fail to a segment in failed/. Raises if the
+        database becomes unavailable, leaving nothing committed.
+
+        Parameters
+        ----------
+        db_session : Session
+            An SQLAlchemy database session.
+        segment : Path
+            The segment to insert.
+        batch_size : int (default 10000)
+            Number of reports to read from the segment at once.
+
+        Returns
+        -------
+        int
+            The number of reports inserted.
+        """
+        num_inserted = 0
+        failed = []
+        for bus_loc_list in self.read_segment(segment, batch_size):
+            for report in bus_loc_list:
+                try:
+                    with db_session.begin_nested():
+                        db_session.bulk_insert_mappings(
+                            BusLocation, [bus_location_mapping(report)]
+                        )
+                    num_inserted += 1
+                except Exception as e:
+                    if self.is_outage(e):
+                        raise
+                    failed.append(report)
+        db_session.commit()
+
+        if len(failed) > 0:
+            failed_dir = self.spool_dir / "failed"
+            failed_dir.mkdir(exist_ok=True)
+            data = "".join(json.dumps(report) + "\n" for report in failed)
+            with open(failed_dir / segment.name, "ab") as f:
+                f.write(gzip.compress(data.encode("utf-8")))
+                f.flush()
+                os.fsync(f.fileno())
+            self.num_failed += len(failed)
+            logging.error(
+                "Moved {} reports which can't be inserted to {}".format(
+                    len(failed), failed_dir / segment.name
+                )
+            )
+
+        return num_inserted
+
+    def log_stats(self):
+        logging.info(
+            "Spool: {} segments, {} bytes, {} spooled, {} drained, {} dropped, {} failed".format(
+                len(self.segments()),
+                self.size_bytes(),
+                self.num_spooled,
+                self.num_drained,
+                self.num_dropped,
+                self.num_failed,
+            )
+        )
@@ -0,0 +1,34 @@
+import gzip
+from io import BytesIO
+
+
+def push_json_to_s3(s3, key: str, json_str: str):
+    """
+    Gzips a JSON string and pushes it to the S3 bucket as a public file.
+
+    Parameters
+    ----------
+    s3 : boto3 S3 resource
+        The S3 resource to upload with.
+    key : str
+        Key to save under in the bucket.
+    json_str : str
+        The JSON to upload.
+
+    """
+    # Only imported when uploading, so the scripts can be imported without a
+    # credentials file
+    import credentials
+
+    # Great snippet from https://gist.github.com/veselosky/9427faa38cee75cd8e27
+    upload_obj = BytesIO()
+    json_comp = gzip.GzipFile(None, "w", 9, upload_obj)
+    json_comp.write(json_str.encode("utf-8"))
+    json_comp.close()
+    s3.Bucket(credentials.S3_BUCKET_NAME).put_object(
+        Key=key,
+        Body=upload_obj.getvalue(),
+        ACL="public-read",
+        ContentType="application/json",
+        ContentEncoding="gzip",
+    )
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where we just skip RSS
+    resource = None
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the process so far in MB, or None if
+    it isn't available on this platform.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class SummariserProfiler:
+    """
+    Records the wall time, rows in and out, and peak memory of each stage of
+    each chunk of a summariser run, then writes them out as a JSON report.
+
+    If chunk_log_path is given, each chunk and its stages are also appended
+    there as a JSON line as soon as the chunk finishes, so a run which crashes
+    or is killed part way still leaves a record of where it got to.
+
+    When disabled, stages and chunks are run without measuring anything, so
+    the summariser can always be written against a profiler.
+
+    Parameters
+    ----------
+    enabled : bool (default False)
+        Whether to record anything.
+    profile_dir : Path (default None)
+        If given, each chunk is also run under cProfile and the stats for the
+        num_slowest slowest chunks are kept in this directory.
+    num_slowest : int (default 3)
+        Number of cProfile dumps to keep.
+    chunk_log_path : Path (default None)
+        If given, a JSON lines file to append each chunk to as it finishes.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        profile_dir: Path = None,
+        num_slowest: int = 3,
+        chunk_log_path: Path = None,
+    ):
+        self.enabled = enabled
+        self.profile_dir = Path(profile_dir) if profile_dir is not None else None
+        self.num_slowest = num_slowest
+        self.chunk_log_path = (
+            Path(chunk_log_path) if chunk_log_path is not None else None
+        )
+        self.stages = []
+        self.chunks = []
+        # (wall time, path) of the cProfile dumps we are keeping
+        self.slowest_dumps = []
+        self.current_chunk = None
+
+        if self.enabled:
+            tracemalloc.start()
+            if self.profile_dir is not None:
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+            if self.chunk_log_path is not None:
+                # Start a fresh log for this run
+                open(self.chunk_log_path, "w").close()
+
+    @contextmanager
+    def chunk(self, start_dt, end_dt):
+        """
+        Wraps the processing of a chunk of time.
+
+        Parameters
+        ----------
+        start_dt : datetime
+            Start of the chunk.
+        end_dt : datetime
+            End of the chunk.
+
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self.current_chunk = "{} to {}".format(start_dt, end_dt)
+        first_stage = len(self.stages)
+        chunk_profile = cProfile.Profile() if self.profile_dir is not None else None
+        start_time = time.perf_counter()
+        if chunk_profile is not None:
+            chunk_profile.enable()
+        try:
+            yield
+        finally:
+            if chunk_profile is not None:
+                chunk_profile.disable()
+            wall_secs = time.perf_counter() - start_time
+            chunk_record = {"chunk": self.current_chunk, "wall_secs": wall_secs}
+            self.chunks.append(chunk_record)
+            if chunk_profile is not None:
+                self.keep_if_slow(chunk_profile, wall_secs, start_dt)
+            if self.chunk_log_path is not None:
+                self.log_chunk(chunk_record, self.stages[first_stage:])
+            self.current_chunk = None
+
+    def log_chunk(self, chunk_record: dict, stages: list):
+        """
+        Appends a finished chunk and its stages to the chunk log as a JSON line,
+        flushed straight to disk.
+        """
+        line = dict(chunk_record, stages=stages, rss_peak_mb=peak_rss_mb())
+        with open(self.chunk_log_path, "a") as f:
+            f.write(json.dumps(line) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None):
+        """
+        Wraps a stage of processing a chunk. The caller can set "rows_out" on
+        the yielded record.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        rows_in : int (default None)
+            Number of rows going into the stage.
+
+        """
+        record = {"chunk": self.current_chunk, "stage": name, "rows_in": rows_in}
+        if not self.enabled:
+            yield record
+            return
+
+        # reset_peak is only in Python 3.9+; before that the peak is for the run
+        # so far
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_secs"] = time.perf_counter() - start_time
+            record["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            record["rss_peak_mb"] = peak_rss_mb()
+            record.setdefault("rows_out", None)
+            self.stages.append(record)
+
+    def keep_if_slow(self, chunk_profile: cProfile.Profile, wall_secs: float, start_dt):
+        """
+        Dumps a chunk's cProfile stats if it is one of the slowest so far,
+        removing the dump it replaces.
+        """
+        if (
+            len(self.slowest_dumps) >= self.num_slowest
+            and wall_secs <= self.slowest_dumps[0][0]
+        ):
+            return
+
+        dump_path = self.profile_dir / "chunk_{}.prof".format(
+            start_dt.strftime("%Y-%m-%dT%H%M")
+        )
+        chunk_profile.dump_stats(str(dump_path))
+        self.slowest_dumps.append((wall_secs, dump_path))
+        self.slowest_dumps.sort(key=lambda dump: dump[0])
+        if len(self.slowest_dumps) > self.num_slowest:
+            _, fastest_path = self.slowest_dumps.pop(0)
+            if fastest_path != dump_path and fastest_path.exists():
+                os.remove(fastest_path)
+
+    def summarise_stages(self) -> dict:
+        """
+        Totals the recorded stages by name.
+
+        Returns
+        -------
+        dict
+            Per stage name, the number of calls, total and max wall time, total
+            rows in and the largest peak memory.
+        """
+        summary = {}
+        for record in self.stages:
+            stage_summary = summary.setdefault(
+                record["stage"],
+                {
+                    "calls": 0,
+                    "wall_secs_total": 0.0,
+                    "wall_secs_max": 0.0,
+                    "rows_in_total": 0,
+                    "tracemalloc_peak_mb_max": 0.0,
+                },
+            )
+            stage_summary["calls"] += 1
+            stage_summary["wall_secs_total"] += record["wall_secs"]
+            stage_summary["wall_secs_max"] = max(
+                stage_summary["wall_secs_max"], record["wall_secs"]
+            )
+            stage_summary["rows_in_total"] += record["rows_in"] or 0
+            stage_summary["tracemalloc_peak_mb_max"] = max(
+                stage_summary["tracemalloc_peak_mb_max"], record["tracemalloc_peak_mb"]
+            )
+        return summary
+
+    def write_report(self, report_path: Path):
+        """
+        Writes everything recorded to a JSON report and prints the per stage
+        totals.
+
+        Parameters
+        ----------
+        report_path : Path
+            Path to save the report to.
+
+        """
+        if not self.enabled:
+            return
+
+        summary = self.summarise_stages()
+        report = {
+            "summary": summary,
+            "peak_rss_mb": peak_rss_mb(),
+            "slowest_chunks": sorted(
+                self.chunks, key=lambda chunk: chunk["wall_secs"], reverse=True
+            )[: self.num_slowest],
+            "cprofile_dumps": [str(path) for _, path in reversed(self.slowest_dumps)],
+            "chunks": self.chunks,
+            "stages": self.stages,
+        }
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        for name, stage_summary in summary.items():
+            print(
+                "{}: {} calls, {:.2f}s total, {:.2f}s max, {:.1f}MB peak".format(
+                    name,
+                    stage_summary["calls"],
+                    stage_summary["wall_secs_total"],
+                    stage_summary["wall_secs_max"],
+                    stage_summary["tracemalloc_peak_mb_max"],
+                )
+            )
+        print("Profile report written to {}".format(report_path))
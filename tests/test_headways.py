@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+from journey_summariser import (
+    EARTH_RADIUS_MILES,
+    calculate_checkpoint_passages,
+    calculate_headways,
+    calculate_journey_progress,
+    preprocess_locations,
+)
+
+
+def make_loop_journeys(
+    num_buses=4,
+    headway_mins=10,
+    loop_miles=4.4,
+    speed_mph=12.0,
+    num_terminal_reports=5,
+    noise_metres=5.0,
+    interval_secs=15,
+):
+    """Buses on a circular route which starts and ends at the same stop,
+    waiting at the stop before they leave."""
+    rng = np.random.default_rng(0)
+    radius_miles = loop_miles / (2 * np.pi)
+    centre_lat, centre_lon = 53.0, -1.5
+    miles_per_report = speed_mph * interval_secs / 3600
+    loop_progress = np.arange(0, loop_miles, miles_per_report)
+    loop_progress = np.append(loop_progress, loop_miles)
+    progress = np.concatenate([np.zeros(num_terminal_reports), loop_progress])
+
+    angle = 2 * np.pi * progress / loop_miles
+    north_miles = radius_miles * (1 - np.cos(angle))
+    east_miles = radius_miles * np.sin(angle)
+    noise_miles = noise_metres / 1609.344
+
+    journeys = []
+    for bus in range(num_buses):
+        departure = pd.Timestamp("2021-03-01 08:00") + pd.Timedelta(
+            minutes=bus * headway_mins
+        )
+        timestamps = departure + pd.to_timedelta(
+            np.arange(len(progress)) * interval_secs, unit="s"
+        )
+        lats = centre_lat + np.degrees(
+            (north_miles + rng.normal(0, noise_miles, len(progress)))
+            / EARTH_RADIUS_MILES
+        )
+        lons = centre_lon + np.degrees(
+            (east_miles + rng.normal(0, noise_miles, len(progress)))
+            / (EARTH_RADIUS_MILES * np.cos(np.radians(centre_lat)))
+        )
+        journeys.append(
+            pd.DataFrame(
+                {
+                    "timestamp": timestamps,
+                    "line_ref": "1",
+                    "direction_ref": "outbound",
+                    "operator_ref": "OP",
+                    "origin_ref": "STOP",
+                    "origin_aimed_departure_time": departure,
+                    "vehicle_lat": lats,
+                    "vehicle_lon": lons,
+                    "vehicle_bearing": 0.0,
+                    "vehicle_journey_ref": str(bus),
+                    "vehicle_ref": "V{}".format(bus),
+                }
+            )
+        )
+    locations_df = pd.concat(journeys, ignore_index=True)
+    locations_df["id"] = np.arange(locations_df.shape[0])
+    return locations_df
+
+
+def test_circular_route_headways():
+    locations_df = make_loop_journeys()
+    progress_df = calculate_journey_progress(preprocess_locations(locations_df))
+
+    # Waiting at the stop the loop starts and ends at doesn't count as having
+    # gone round
+    for _, journey_df in progress_df.groupby("journey_key"):
+        waiting = journey_df.sort_values(by="timestamp").iloc[:5]
+        assert waiting["progress_miles"].max() < 0.1
+
+    passages_df = calculate_checkpoint_passages(progress_df, 0.25)
+    num_checkpoints = passages_df.groupby("journey_key").size()
+    assert len(num_checkpoints) == 4
+    assert (num_checkpoints >= 17).all()
+
+    # GPS noise can put a waiting bus just past the first checkpoint, so only
+    # compare from the next one on
+    headways_df = calculate_headways(passages_df, bunching_threshold_mins=2.0)
+    headways_df = headways_df[headways_df["checkpoint_miles"] > 0]
+    assert len(headways_df) == 3 * 17
+    assert np.allclose(headways_df["headway_mins"], 10, atol=0.5)
+    assert not headways_df["is_bunched"].any()
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+from journey_summariser import (
+    calculate_deltas,
+    convert_locations_to_journey_summaries,
+    summarise_journey_stats,
+)
+
+
+def make_locations(seed=0, num_journeys=30):
+    """Random journeys on a few lines and operators, including a journey with
+    no vehicle_journey_ref and journeys too short to summarise."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for journey in range(num_journeys):
+        departure = pd.Timestamp("2021-03-01 07:00") + pd.Timedelta(
+            minutes=int(rng.integers(0, 50))
+        )
+        line_ref = str(rng.integers(1, 4))
+        vehicle_journey_ref = str(rng.integers(100, 110)) if journey != 0 else None
+        operator_ref = "OP{}".format(rng.integers(1, 3))
+        lat = 51.5 + rng.random() * 0.01
+        timestamp = departure
+        for _ in range(int(rng.integers(1, 12))):
+            timestamp += pd.Timedelta(seconds=int(rng.integers(0, 40)))
+            lat += rng.random() * 0.001
+            rows.append(
+                {
+                    "timestamp": timestamp,
+                    "line_ref": line_ref,
+                    "direction_ref": rng.choice(["INBOUND", "OUTBOUND"]),
+                    "operator_ref": operator_ref,
+                    "origin_ref": "O" + line_ref,
+                    "origin_name": "Origin",
+                    "destination_ref": "D",
+                    "destination_name": "Destination",
+                    "origin_aimed_departure_time": departure,
+                    "vehicle_lat": lat,
+                    "vehicle_lon": -0.1,
+                    "vehicle_bearing": 1.0,
+                    "vehicle_journey_ref": vehicle_journey_ref,
+                    "vehicle_ref": "V{}".format(vehicle_journey_ref),
+                }
+            )
+    locations_df = pd.DataFrame(rows)
+    locations_df["id"] = np.arange(locations_df.shape[0])
+    return locations_df
+
+
+def string_keyed_journey_summaries(raw_locations_df, drop_threshold=2):
+    """The summariser as it was before journeys had integer keys, grouping on
+    reference strings built for every report."""
+    raw_locations_df = raw_locations_df.drop_duplicates(
+        subset=[
+            "timestamp",
+            "line_ref",
+            "direction_ref",
+            "vehicle_lat",
+            "vehicle_lon",
+            "vehicle_bearing",
+        ]
+    ).copy()
+    raw_locations_df["hour"] = raw_locations_df["origin_aimed_departure_time"].dt.floor(
+        "h"
+    )
+    raw_locations_df["vehicle_journey_date_ref"] = (
+        raw_locations_df["origin_aimed_departure_time"].dt.strftime("%Y-%m-%d")
+        + "_"
+        + raw_locations_df["vehicle_journey_ref"]
+    )
+    raw_locations_df["journey_date_line_ref"] = (
+        raw_locations_df["operator_ref"]
+        + "_"
+        + raw_locations_df["origin_aimed_departure_time"].dt.strftime("%Y-%m-%dT%H:%M%s")
+        + "_"
+        + raw_locations_df["line_ref"]
+        + "_"
+        + raw_locations_df["vehicle_journey_ref"]
+    )
+    jdl_count = raw_locations_df.groupby("journey_date_line_ref")["id"].count()
+    journeys_to_drop = jdl_count[jdl_count < drop_threshold].index
+    raw_locations_df = raw_locations_df[
+        ~raw_locations_df["journey_date_line_ref"].isin(journeys_to_drop)
+    ]
+    raw_locations_df = raw_locations_df.sort_values(by=["timestamp", "id"]).reset_index(
+        drop=True
+    )
+
+    def summarise_journey(journey_df):
+        metadata = journey_df[
+            [
+                "line_ref",
+                "direction_ref",
+                "origin_ref",
+                "origin_name",
+                "destination_ref",
+                "destination_name",
+                "hour",
+                "vehicle_journey_date_ref",
+                "journey_date_line_ref",
+                "vehicle_ref",
+            ]
+        ].iloc[0]
+        return metadata.append(summarise_journey_stats(calculate_deltas(journey_df)))
+
+    return raw_locations_df.groupby(["journey_date_line_ref"]).apply(summarise_journey)
+
+
+def test_integer_keys_match_string_keys():
+    for seed in range(3):
+        locations_df = make_locations(seed)
+        expected = string_keyed_journey_summaries(locations_df.copy()).reset_index(
+            drop=True
+        )
+        actual = convert_locations_to_journey_summaries(locations_df.copy())
+
+        assert sorted(actual.columns) == sorted(expected.columns)
+        pd.testing.assert_frame_equal(
+            actual[expected.columns].reset_index(drop=True),
+            expected,
+            check_dtype=False,
+        )
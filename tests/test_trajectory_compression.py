@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from trajectory_compression import compress_locations, project_to_metres
+
+
+def make_journey(lats, lons, interval_secs=15):
+    num_points = len(lats)
+    timestamps = pd.date_range(
+        "2021-03-01 08:00", periods=num_points, freq="{}s".format(interval_secs)
+    )
+    return pd.DataFrame(
+        {
+            "id": range(num_points),
+            "timestamp": timestamps,
+            "vehicle_lat": lats,
+            "vehicle_lon": lons,
+            "operator_ref": "OP",
+            "origin_aimed_departure_time": timestamps[0],
+            "line_ref": "1",
+            "vehicle_journey_ref": "1",
+        }
+    )
+
+
+def max_removed_error(journey_df, compressed_df):
+    """Largest distance from a report to the compressed track at the same time."""
+    x, y = project_to_metres(
+        journey_df["vehicle_lat"].to_numpy(), journey_df["vehicle_lon"].to_numpy()
+    )
+    t = (journey_df["timestamp"] - journey_df["timestamp"].iloc[0]).dt.total_seconds()
+    kept = journey_df["id"].isin(compressed_df["id"]).to_numpy()
+    interp_x = np.interp(t, t[kept], x[kept])
+    interp_y = np.interp(t, t[kept], y[kept])
+    return np.max(np.hypot(x - interp_x, y - interp_y))
+
+
+def test_stationary_runs_collapse_to_first_and_last():
+    lats = [53.0] * 20 + [53.001, 53.002] + [53.003] * 20
+    journey_df = make_journey(lats, [-1.5] * len(lats))
+
+    compressed_df = compress_locations(journey_df, max_error_m=10.0)
+
+    assert compressed_df["id"].tolist() == [0, 19, 22, 41]
+
+
+def test_creeping_bus_stays_within_error_bound():
+    # 4m per report, below the 5m stationary tolerance
+    metres_per_degree = 111195.0
+    lats = 53.0 + np.arange(60) * 4 / metres_per_degree
+    journey_df = make_journey(lats, [-1.5] * 60)
+    # Stop halfway, so a straight line between the ends is well out in time
+    journey_df.loc[30:, "timestamp"] += pd.Timedelta(minutes=5)
+
+    compressed_df = compress_locations(
+        journey_df, stationary_tolerance_m=5.0, max_error_m=10.0
+    )
+
+    assert compressed_df.shape[0] < journey_df.shape[0]
+    assert max_removed_error(journey_df, compressed_df) <= 10.0
+
+
+def test_first_and_last_reports_kept():
+    rng = np.random.default_rng(0)
+    lats = 53.0 + np.cumsum(rng.normal(0, 0.0003, 200))
+    lons = -1.5 + np.cumsum(rng.normal(0, 0.0003, 200))
+    journey_df = make_journey(lats, lons)
+
+    compressed_df = compress_locations(journey_df, max_error_m=25.0)
+
+    assert compressed_df["id"].iloc[0] == 0
+    assert compressed_df["id"].iloc[-1] == 199
+    assert max_removed_error(journey_df, compressed_df) <= 25.0
@@ -0,0 +1,283 @@
+import sys
+import csv
+import json
+import time
+import argparse
+import datetime
+from collections import OrderedDict
+
+import dateutil.parser
+from sqlalchemy import create_engine, select, and_
+
+from bus_data_models import BusLocation, TRACK_COLUMNS
+
+
+class TrackCache:
+    """
+    A small least recently used cache of track lookups. Tracks longer than
+    max_rows are not cached, so one large lookup can't push everything else out.
+
+    Entries expire after ttl_seconds. Even a range which ended in the past can
+    change, as spooled reports are inserted late and trajectory compression
+    deletes reports, so a cached track may be up to ttl_seconds out of date.
+
+    Parameters
+    ----------
+    max_entries : int (default 128)
+        Number of tracks to keep.
+    max_rows : int (default 10000)
+        Longest track to cache.
+    ttl_seconds : float (default 300)
+        How long to keep each track for.
+    """
+
+    def __init__(
+        self, max_entries: int = 128, max_rows: int = 10000, ttl_seconds: float = 300
+    ):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.ttl_seconds = ttl_seconds
+        # key -> (time cached, rows)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        if key in self.entries:
+            cached_at, rows = self.entries[key]
+            if time.monotonic() - cached_at <= self.ttl_seconds:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return rows
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, rows: list):
+        self.entries[key] = (time.monotonic(), rows)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+TRACK_CACHE = TrackCache()
+
+
+def to_naive_utc(dt: datetime.datetime) -> datetime.datetime:
+    """
+    Converts a timezone aware datetime to naive UTC, to match the timestamps
+    in the database. Naive datetimes are assumed to be UTC already.
+    """
+    if dt is None or dt.tzinfo is None:
+        return dt
+    return dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def get_track(
+    engine,
+    vehicle_ref: str = None,
+    vehicle_journey_ref: str = None,
+    start_dt: datetime.datetime = None,
+    end_dt: datetime.datetime = None,
+    cache: TrackCache = TRACK_CACHE,
+    batch_size: int = 10000,
+):
+    """
+    Looks up the track of a vehicle or a journey over a time range, in time
+    order. Exactly one of vehicle_ref and vehicle_journey_ref must be given.
+
+    Rows are streamed from the database with a server side cursor so large
+    tracks are never all held in memory. The lookup is served by the covering
+    indexes from create_track_indexes, so it doesn't touch the table itself.
+
+    Parameters
+    ----------
+    engine : Engine
+        An SQLAlchemy engine.
+    vehicle_ref : str (default None)
+        The vehicle to look up.
+    vehicle_journey_ref : str (default None)
+        The journey to look up.
+    start_dt : datetime (default None)
+        Only include reports at or after this time. Naive times are taken as
+        UTC.
+    end_dt : datetime (default None)
+        Only include reports before this time. Naive times are taken as UTC.
+    cache : TrackCache (default TRACK_CACHE)
+        Cache of recent lookups. Only lookups which end in the past are cached,
+        as later ones are still being written to. Pass None to skip the cache.
+    batch_size : int (default 10000)
+        Number of rows to fetch from the database at once.
+
+    Returns
+    -------
+    generator of tuple
+        The reports, with values in the order of TRACK_COLUMNS.
+    """
+    if (vehicle_ref is None) == (vehicle_journey_ref is None):
+        raise ValueError("Give exactly one of vehicle_ref or vehicle_journey_ref.")
+
+    return stream_track(
+        engine,
+        vehicle_ref,
+        vehicle_journey_ref,
+        to_naive_utc(start_dt),
+        to_naive_utc(end_dt),
+        cache,
+        batch_size,
+    )
+
+
+def stream_track(
+    engine,
+    vehicle_ref: str,
+    vehicle_journey_ref: str,
+    start_dt: datetime.datetime,
+    end_dt: datetime.datetime,
+    cache: TrackCache,
+    batch_size: int,
+):
+    """
+    Generates the rows for get_track, which checks the arguments first so
+    mistakes are raised straight away rather than on the first row.
+    """
+    key = (vehicle_ref, vehicle_journey_ref, start_dt, end_dt)
+    if cache is not None:
+        cached_rows = cache.get(key)
+        if cached_rows is not None:
+            yield from cached_rows
+            return
+
+    if vehicle_ref is not None:
+        conditions = [BusLocation.vehicle_ref == vehicle_ref]
+    else:
+        conditions = [BusLocation.vehicle_journey_ref == vehicle_journey_ref]
+    if start_dt is not None:
+        conditions.append(BusLocation.timestamp >= start_dt)
+    if end_dt is not None:
+        conditions.append(BusLocation.timestamp < end_dt)
+
+    track_qry = (
+        select([getattr(BusLocation, column) for column in TRACK_COLUMNS])
+        .where(and_(*conditions))
+        .order_by(BusLocation.timestamp)
+    )
+
+    cacheable = (
+        cache is not None
+        and end_dt is not None
+        and end_dt <= datetime.datetime.utcnow()
+    )
+    rows = []
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(track_qry)
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            for row in batch:
+                row = tuple(row)
+                if cacheable:
+                    rows.append(row)
+                    if len(rows) > cache.max_rows:
+                        cacheable = False
+                        rows = []
+                yield row
+
+    if cacheable:
+        cache.put(key, rows)
+
+
+def write_csv(rows, f):
+    """
+    Writes track rows to a file as CSV, one row at a time.
+    """
+    writer = csv.writer(f)
+    writer.writerow(TRACK_COLUMNS)
+    for row in rows:
+        writer.writerow([row[0].isoformat()] + list(row[1:]))
+
+
+def write_geojson(rows, f):
+    """
+    Writes track rows to a file as a GeoJSON FeatureCollection of points, one
+    feature at a time.
+    """
+    lat_idx = TRACK_COLUMNS.index("vehicle_lat")
+    lon_idx = TRACK_COLUMNS.index("vehicle_lon")
+    property_columns = [
+        (idx, column)
+        for idx, column in enumerate(TRACK_COLUMNS)
+        if column not in ("vehicle_lat", "vehicle_lon")
+    ]
+
+    f.write('{"type": "FeatureCollection", "features": [')
+    for i, row in enumerate(rows):
+        properties = {column: row[idx] for idx, column in property_columns}
+        properties["timestamp"] = properties["timestamp"].isoformat()
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [row[lon_idx], row[lat_idx]]},
+            "properties": properties,
+        }
+        f.write(("\n" if i == 0 else ",\n") + json.dumps(feature))
+    f.write("\n]}\n")
+
+
+if __name__ == "__main__":
+    # Only needed when run as a script, so get_track can be imported without a
+    # credentials file
+    import credentials
+
+    parser = argparse.ArgumentParser(
+        description="Tool to look up the historical track of a vehicle or journey.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    ref_group = parser.add_mutually_exclusive_group(required=True)
+    ref_group.add_argument("--vehicle_ref", type=str, help="The vehicle to look up.")
+    ref_group.add_argument(
+        "--journey_ref", type=str, help="The vehicle journey ref to look up."
+    )
+    parser.add_argument(
+        "--start", type=str, default=None, help="ISO start time of the lookup."
+    )
+    parser.add_argument(
+        "--end", type=str, default=None, help="ISO end time of the lookup."
+    )
+    parser.add_argument(
+        "--format",
+        choices=["geojson", "csv"],
+        default="geojson",
+        help="Output format.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Path to write to. Writes to stdout if not given.",
+    )
+    args = parser.parse_args()
+
+    engine = create_engine(
+        "postgresql://{}:{}@{}:{}".format(
+            credentials.POSTGRES_USER,
+            credentials.POSTGRES_PASSWORD,
+            credentials.POSTGRES_HOST,
+            credentials.POSTGRES_PORT,
+        )
+    )
+
+    track_rows = get_track(
+        engine,
+        vehicle_ref=args.vehicle_ref,
+        vehicle_journey_ref=args.journey_ref,
+        start_dt=dateutil.parser.isoparse(args.start) if args.start else None,
+        end_dt=dateutil.parser.isoparse(args.end) if args.end else None,
+    )
+    write_track = write_geojson if args.format == "geojson" else write_csv
+
+    if args.output is None:
+        write_track(track_rows, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as f:
+            write_track(track_rows, f)
@@ -0,0 +1,398 @@
+import datetime
+import argparse
+
+import dateutil.rrule
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, and_
+from sqlalchemy.orm import sessionmaker, Session
+
+from bus_data_models import Base, BusLocation
+
+# Mean radius of the Earth, used for the local flat projection below
+EARTH_RADIUS_M = 6371008.8
+
+# Columns which together identify a single bus journey - the same fields the
+# summariser concatenates into journey_date_line_ref
+JOURNEY_KEY_COLUMNS = [
+    "operator_ref",
+    "origin_aimed_departure_time",
+    "line_ref",
+    "vehicle_journey_ref",
+]
+
+
+def project_to_metres(lats: np.ndarray, lons: np.ndarray):
+    """
+    Projects latitudes and longitudes onto a flat plane in metres, centred on
+    the mean latitude. This is plenty accurate over the extent of a single bus
+    journey and far cheaper than geodesic distances.
+
+    Parameters
+    ----------
+    lats : np.ndarray
+        Latitudes in degrees.
+    lons : np.ndarray
+        Longitudes in degrees.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        The x and y positions in metres.
+    """
+    lat_rad = np.radians(lats)
+    lon_rad = np.radians(lons)
+    x = EARTH_RADIUS_M * lon_rad * np.cos(np.mean(lat_rad))
+    y = EARTH_RADIUS_M * lat_rad
+    return x, y
+
+
+def find_stationary_points(
+    x: np.ndarray, y: np.ndarray, stationary_tolerance_m: float = 5.0
+) -> np.ndarray:
+    """
+    Run-length collapses stationary points. A stationary run starts at a point
+    and carries on while the following points stay within
+    stationary_tolerance_m of that first point, so a bus creeping forward a
+    little at a time still starts new runs. Only the first and last point of
+    each run are kept, so the time spent stopped is still recorded.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Projected x positions in metres, sorted by time.
+    y : np.ndarray
+        Projected y positions in metres, sorted by time.
+    stationary_tolerance_m : float (default 5.0)
+        Movement below this distance counts as stationary.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of points to keep.
+    """
+    num_points = x.shape[0]
+    keep = np.ones(num_points, dtype=bool)
+    if num_points < 3:
+        return keep
+
+    # stationary[i] is True if point i is still within the tolerance of the
+    # first point of the current run
+    stationary = np.zeros(num_points, dtype=bool)
+    run_start = 0
+    for i in range(1, num_points):
+        if np.hypot(x[i] - x[run_start], y[i] - y[run_start]) < stationary_tolerance_m:
+            stationary[i] = True
+        else:
+            run_start = i
+    # Drop a point if it is stationary and so is the next one, i.e. it is in
+    # the middle of a run
+    keep[1:-1] = ~(stationary[1:-1] & stationary[2:])
+    return keep
+
+
+def simplify_trajectory(
+    x: np.ndarray,
+    y: np.ndarray,
+    t: np.ndarray,
+    max_error_m: float = 10.0,
+    keep: np.ndarray = None,
+) -> np.ndarray:
+    """
+    Simplifies a trajectory with Douglas-Peucker, using the synchronised
+    euclidean distance (SED) as the error measure. SED compares each point with
+    where the bus would be at that time if it moved at constant speed between
+    the kept points, so timings are preserved as well as the shape.
+
+    Every point between two kept points is checked, so no removed point is more
+    than max_error_m from the simplified trajectory.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Projected x positions in metres, sorted by time.
+    y : np.ndarray
+        Projected y positions in metres, sorted by time.
+    t : np.ndarray
+        Timestamps in seconds.
+    max_error_m : float (default 10.0)
+        Maximum allowed SED for a removed point.
+    keep : np.ndarray (default None)
+        Boolean mask of points already chosen to keep, e.g. from a coarser
+        simplification. Points are only added to it. If not given, we start
+        from just the first and last points.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of points to keep.
+    """
+    num_points = x.shape[0]
+    if keep is None:
+        keep = np.zeros(num_points, dtype=bool)
+    else:
+        keep = keep.copy()
+    if num_points == 0:
+        return keep
+    keep[0] = True
+    keep[-1] = True
+
+    # Iterative rather than recursive so long journeys can't blow the stack
+    kept_idx = np.flatnonzero(keep)
+    stack = list(zip(kept_idx[:-1], kept_idx[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        inner = slice(start + 1, end)
+        duration = t[end] - t[start]
+        if duration > 0:
+            frac = (t[inner] - t[start]) / duration
+        else:
+            frac = np.zeros(end - start - 1)
+        interp_x = x[start] + frac * (x[end] - x[start])
+        interp_y = y[start] + frac * (y[end] - y[start])
+        errors = np.hypot(x[inner] - interp_x, y[inner] - interp_y)
+
+        worst = np.argmax(errors)
+        if errors[worst] > max_error_m:
+            split = start + 1 + worst
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return keep
+
+
+def compress_journey(
+    journey_df: pd.DataFrame,
+    stationary_tolerance_m: float = 5.0,
+    max_error_m: float = 10.0,
+) -> pd.Series:
+    """
+    Compresses the positions of a single journey, first collapsing stationary
+    runs then simplifying what is left. The first and last reports of the
+    journey are always kept.
+
+    The cheap passes only look at some of the points, so we finish by checking
+    every original point against the result and adding back any needed to keep
+    within max_error_m.
+
+    Parameters
+    ----------
+    journey_df : pd.DataFrame
+        Bus location reports for one journey.
+    stationary_tolerance_m : float (default 5.0)
+        Movement below this distance counts as stationary.
+    max_error_m : float (default 10.0)
+        Maximum position error allowed for a removed report. Set to 0 to only
+        collapse stationary runs, in which case removed reports can be up to
+        twice stationary_tolerance_m out.
+
+    Returns
+    -------
+    pd.Series
+        Boolean mask, aligned with journey_df, of reports to keep.
+    """
+    journey_df = journey_df.sort_values(by=["timestamp", "id"])
+    x, y = project_to_metres(
+        journey_df["vehicle_lat"].to_numpy(), journey_df["vehicle_lon"].to_numpy()
+    )
+    keep = find_stationary_points(x, y, stationary_tolerance_m)
+
+    if max_error_m > 0:
+        t = (
+            journey_df["timestamp"] - journey_df["timestamp"].iloc[0]
+        ).dt.total_seconds().to_numpy()
+        kept_idx = np.flatnonzero(keep)
+        simplified = simplify_trajectory(
+            x[kept_idx], y[kept_idx], t[kept_idx], max_error_m
+        )
+        keep[kept_idx[~simplified]] = False
+        # Enforce the error bound against every original point
+        keep = simplify_trajectory(x, y, t, max_error_m, keep=keep)
+
+    return pd.Series(keep, index=journey_df.index)
+
+
+def compress_locations(
+    locations_df: pd.DataFrame,
+    stationary_tolerance_m: float = 5.0,
+    max_error_m: float = 10.0,
+) -> pd.DataFrame:
+    """
+    Compresses every journey in a set of bus location reports.
+
+    Parameters
+    ----------
+    locations_df : pd.DataFrame
+        Bus location reports, as read from the bus_location table.
+    stationary_tolerance_m : float (default 5.0)
+        Movement below this distance counts as stationary.
+    max_error_m : float (default 10.0)
+        Maximum position error allowed for a removed report.
+
+    Returns
+    -------
+    pd.DataFrame
+        The reports to keep.
+    """
+    if locations_df.shape[0] == 0:
+        return locations_df
+
+    keep = pd.concat(
+        [
+            compress_journey(journey_df, stationary_tolerance_m, max_error_m)
+            for _, journey_df in locations_df.groupby(JOURNEY_KEY_COLUMNS)
+        ]
+    )
+    # Anything with a missing key column isn't grouped, so leave it alone
+    keep = keep.reindex(locations_df.index, fill_value=True)
+    return locations_df[keep]
+
+
+def compress_period(
+    db_session: Session,
+    start_dt: datetime,
+    end_dt: datetime,
+    chunk_size: int = 1,
+    stationary_tolerance_m: float = 5.0,
+    max_error_m: float = 10.0,
+    dry_run: bool = False,
+):
+    """
+    Compresses the stored bus locations for a period, deleting the reports
+    which are not needed to reconstruct each journey within the error bound.
+
+    As in process_day, we filter by origin_aimed_departure_time so that each
+    journey is always compressed as a whole.
+
+    Parameters
+    ----------
+    db_session : Session
+        An SQLAlchemy database session.
+    start_dt : datetime
+        Start time of the period to compress.
+    end_dt : datetime
+        End time of the period to compress.
+    chunk_size : int (default 1)
+        Number of hours to process each loop iteration.
+    stationary_tolerance_m : float (default 5.0)
+        Movement below this distance counts as stationary.
+    max_error_m : float (default 10.0)
+        Maximum position error allowed for a removed report.
+    dry_run : bool (default False)
+        If True, report what would be removed without deleting anything.
+
+    """
+    day_rrule = dateutil.rrule.rrule(
+        freq=dateutil.rrule.HOURLY,
+        interval=chunk_size,
+        dtstart=start_dt,
+        until=end_dt - datetime.timedelta(hours=chunk_size),
+    )
+    offset_day_rrule = dateutil.rrule.rrule(
+        freq=dateutil.rrule.HOURLY,
+        interval=chunk_size,
+        dtstart=start_dt + datetime.timedelta(hours=chunk_size),
+        until=end_dt,
+    )
+    total_before = 0
+    total_after = 0
+    for start_hour, end_hour in zip(day_rrule, offset_day_rrule):
+        hour_bus_locs_qry = db_session.query(BusLocation).filter(
+            and_(
+                BusLocation.origin_aimed_departure_time >= start_hour,
+                BusLocation.origin_aimed_departure_time < end_hour,
+            )
+        )
+        hour_bus_locs_df = pd.read_sql(
+            hour_bus_locs_qry.statement, hour_bus_locs_qry.session.bind
+        )
+        compressed_df = compress_locations(
+            hour_bus_locs_df, stationary_tolerance_m, max_error_m
+        )
+        ids_to_drop = hour_bus_locs_df.loc[
+            ~hour_bus_locs_df["id"].isin(compressed_df["id"]), "id"
+        ].tolist()
+
+        print(
+            "{} to {}: {} -> {} reports".format(
+                start_hour, end_hour, hour_bus_locs_df.shape[0], compressed_df.shape[0]
+            )
+        )
+        total_before += hour_bus_locs_df.shape[0]
+        total_after += compressed_df.shape[0]
+
+        if not dry_run and len(ids_to_drop) > 0:
+            # Delete in batches to keep the IN clause a sensible size
+            for i in range(0, len(ids_to_drop), 10000):
+                db_session.query(BusLocation).filter(
+                    BusLocation.id.in_(ids_to_drop[i : i + 10000])
+                ).delete(synchronize_session=False)
+            db_session.commit()
+
+    print("Total: {} -> {} reports".format(total_before, total_after))
+
+
+if __name__ == "__main__":
+    # Only needed when run as a script, so the functions above can be imported
+    # without a credentials file
+    import credentials
+
+    parser = argparse.ArgumentParser(
+        description="Tool to compress stored bus trajectories by removing redundant location reports.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--days_ago",
+        help="Which day to compress, counting back from today.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--stationary_tolerance",
+        help="Distance in metres below which a bus is considered stationary.",
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--max_error",
+        help="Maximum position error in metres allowed when simplifying a trajectory. 0 only collapses stationary runs.",
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Report how much would be removed without deleting anything.",
+    )
+    args = parser.parse_args()
+
+    engine = create_engine(
+        "postgresql://{}:{}@{}:{}".format(
+            credentials.POSTGRES_USER,
+            credentials.POSTGRES_PASSWORD,
+            credentials.POSTGRES_HOST,
+            credentials.POSTGRES_PORT,
+        )
+    )
+    Base.metadata.bind = engine
+
+    DBSession = sessionmaker(bind=engine)
+    session = DBSession()
+
+    today = datetime.date.today()
+    end_dt = datetime.datetime(today.year, today.month, today.day) - datetime.timedelta(
+        days=args.days_ago - 1
+    )
+    start_dt = end_dt - datetime.timedelta(days=1)
+    compress_period(
+        session,
+        start_dt,
+        end_dt,
+        stationary_tolerance_m=args.stationary_tolerance,
+        max_error_m=args.max_error,
+        dry_run=args.dry_run,
+    )